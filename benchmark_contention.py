@@ -0,0 +1,146 @@
+# benchmark_contention.py
+# CPU 争用基准测试: 多个并发客户端在同一进程中执行 "ViT 特征提取 + Faiss 搜索",
+# 比较未配置线程数 (torch 与 Faiss 各自默认占满全部核心) 和按 core.resources 线程预算运行时的延迟分布, 重点关注 p99。
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+import numpy as np
+
+from benchmark_extractor import generate_synthetic_images, parse_str_list
+from core.config import VIT_MODEL_NAME, FEATURE_DIM, K_RESULTS, SERVICE_CONCURRENCY
+
+
+def _run_config(config: str, image_paths: list[str], options: dict, result_queue):
+    # 每个配置在独立的子进程中运行: torch inter-op 线程数只能在进程内设置一次
+    try:
+        import faiss
+        from core.feature_extractor import ViTFeatureExtractor
+        from core.resources import apply_faiss_threads, apply_thread_budget, query_slot
+
+        budget = None
+        if config != "default":
+            budget = apply_thread_budget(config, concurrency=options["clients"])
+        extractor = ViTFeatureExtractor(model_name=options["model"],
+                                        decode_workers=budget["decode_workers"] if budget else 1)
+
+        rng = np.random.default_rng(0)
+        vectors = rng.standard_normal((options["index_size"], FEATURE_DIM), dtype=np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        index = faiss.IndexFlatIP(FEATURE_DIM)
+        index.add(vectors)
+
+        def run_query(image_path: str):
+            with query_slot():
+                feature = extractor.extract_features(image_path)
+                index.search(feature.reshape(1, -1), options["k"])
+
+        for image_path in image_paths[:2]: # 预热
+            run_query(image_path)
+
+        latencies = []
+        queries_per_client = options["queries_per_client"]
+
+        def client(client_id: int):
+            apply_faiss_threads() # Faiss OpenMP 线程数按线程生效
+            for i in range(queries_per_client):
+                image_path = image_paths[(client_id * queries_per_client + i) % len(image_paths)]
+                start = time.perf_counter()
+                run_query(image_path)
+                latencies.append((time.perf_counter() - start) * 1000)
+
+        threads = [threading.Thread(target=client, args=(i,)) for i in range(options["clients"])]
+        wall_start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        wall_seconds = time.perf_counter() - wall_start
+
+        result_queue.put({
+            "config": config,
+            "budget": budget,
+            "queries": len(latencies),
+            "qps": len(latencies) / wall_seconds,
+            "mean_ms": float(np.mean(latencies)),
+            "p50_ms": float(np.percentile(latencies, 50)),
+            "p99_ms": float(np.percentile(latencies, 99)),
+        })
+    except Exception as e:
+        result_queue.put({"config": config, "error": str(e)})
+
+
+def run_config_in_subprocess(config: str, image_paths: list[str], options: dict) -> dict:
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=_run_config, args=(config, image_paths, options, result_queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=1)
+        except Exception:
+            if not process.is_alive():
+                result = {"config": config, "error": f"子进程异常退出, 退出码 {process.exitcode}"}
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="torch 与 Faiss 同进程运行时的 CPU 争用基准测试")
+    parser.add_argument("--configs", default="default,interactive,service",
+                        help="逗号分隔的配置: default (不配置线程数) 或 core.resources 中的资源模式")
+    parser.add_argument("--clients", type=int, default=SERVICE_CONCURRENCY, help="并发客户端线程数")
+    parser.add_argument("--queries-per-client", type=int, default=25, help="每个客户端的查询数")
+    parser.add_argument("--index-size", type=int, default=50000, help="合成 Faiss 索引的向量数")
+    parser.add_argument("--k", type=int, default=K_RESULTS, help="每次搜索返回的结果数")
+    parser.add_argument("--model", default=VIT_MODEL_NAME, help="模型名称")
+    parser.add_argument("--output", default="benchmark_contention.json", help="结果 JSON 输出路径")
+    args = parser.parse_args()
+
+    options = {"clients": args.clients, "queries_per_client": args.queries_per_client,
+               "index_size": args.index_size, "k": args.k, "model": args.model}
+    print(f"--- CPU 争用基准测试: {args.clients} 个并发客户端, 每个 {args.queries_per_client} 次查询, "
+          f"索引 {args.index_size} 个向量 ---")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="contention_bench_") as image_dir:
+        image_paths = generate_synthetic_images(image_dir, 32, ["640x480", "1920x1080"], ["jpg", "png"])
+        for config in parse_str_list(args.configs):
+            result = run_config_in_subprocess(config, image_paths, options)
+            results.append(result)
+            if "error" in result:
+                print(f"[错误] {config}: {result['error']}")
+                continue
+            print(f"{config:<12} p50 {result['p50_ms']:.2f} ms  p99 {result['p99_ms']:.2f} ms  "
+                  f"平均 {result['mean_ms']:.2f} ms  吞吐 {result['qps']:.2f} 查询/秒")
+
+    baseline = next((r for r in results if r["config"] == "default" and "error" not in r), None)
+    if baseline is not None:
+        for result in results:
+            if result is baseline or "error" in result:
+                continue
+            improvement = (baseline["p99_ms"] - result["p99_ms"]) / baseline["p99_ms"]
+            result["p99_improvement_vs_default"] = improvement
+            print(f"{result['config']}: p99 相对 default {'降低' if improvement >= 0 else '升高'} {abs(improvement):.1%}")
+
+    report = {
+        "meta": {**options, "cpu_count": os.cpu_count(), "platform": platform.platform(),
+                 "python": platform.python_version(), "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S")},
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}")
+    if any("error" in r for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+# benchmark_extractor.py
+# 特征提取吞吐量基准测试: 使用本地生成的合成图像, 遍历 batch 大小 / torch 线程数 / 预处理方式 / 工作进程数,
+# 报告每秒图像数、各阶段 (解码、预处理、前向、归一化) 单图耗时和峰值内存, 并输出 JSON 供 CI 与基线比较。
+import argparse
+import json
+import multiprocessing as mp
+import os
+import platform
+import sys
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import product
+
+import numpy as np
+from PIL import Image
+
+from core.config import VIT_MODEL_NAME
+
+try:
+    import resource # 仅 Unix 可用
+except ImportError:
+    resource = None
+
+DEFAULT_RESOLUTIONS = "224x224,640x480,1920x1080"
+DEFAULT_FORMATS = "jpg,png,bmp"
+
+_worker_extractor = None # 每个工作进程各自加载一份模型
+
+
+def parse_int_list(text: str) -> list[int]:
+    return [int(item) for item in text.split(",") if item.strip()]
+
+
+def parse_str_list(text: str) -> list[str]:
+    return [item.strip() for item in text.split(",") if item.strip()]
+
+
+def generate_synthetic_images(output_dir: str, count: int, resolutions: list[str], formats: list[str]) -> list[str]:
+    # 低频渐变 + 噪声, 固定随机种子, 保证每次运行的解码/编码负载一致
+    rng = np.random.default_rng(0)
+    variants = list(product(resolutions, formats))
+    paths = []
+    for i in range(count):
+        resolution, fmt = variants[i % len(variants)]
+        width, height = (int(v) for v in resolution.lower().split("x"))
+        gradient = np.linspace(0, 255, width, dtype=np.float32)[None, :, None]
+        noise = rng.normal(0, 40, size=(height, width, 3)).astype(np.float32)
+        pixels = np.clip(gradient + noise + rng.uniform(0, 64, size=3), 0, 255).astype(np.uint8)
+        path = os.path.join(output_dir, f"synthetic_{i:05d}_{resolution}.{fmt}")
+        Image.fromarray(pixels, "RGB").save(path)
+        paths.append(path)
+    return paths
+
+
+def peak_rss_mb(who) -> float | None:
+    if resource is None:
+        return None
+    rss = resource.getrusage(who).ru_maxrss
+    # Linux 上 ru_maxrss 单位为 KB, macOS 上为字节
+    return rss / 2**20 if sys.platform == "darwin" else rss / 2**10
+
+
+def _init_worker(model_name: str, num_threads: int):
+    global _worker_extractor
+    import torch
+    from core.feature_extractor import ViTFeatureExtractor
+    torch.set_num_threads(num_threads)
+    _worker_extractor = ViTFeatureExtractor(model_name=model_name)
+
+
+def _run_shard(image_paths: list[str], batch_size: int, preprocess: str) -> tuple[int, float, dict]:
+    # 先用一个 batch 预热 (不计时), 再对整个分片计时
+    _worker_extractor.extract_features_batch(image_paths[:batch_size], preprocess=preprocess)
+    timings = {}
+    processed = 0
+    start = time.perf_counter()
+    for i in range(0, len(image_paths), batch_size):
+        features, _ = _worker_extractor.extract_features_batch(image_paths[i:i + batch_size],
+                                                               preprocess=preprocess, timings=timings)
+        processed += features.shape[0]
+    return processed, time.perf_counter() - start, timings
+
+
+def _run_setting(setting: dict, image_paths: list[str], model_name: str, result_queue):
+    # 每个配置在独立的子进程中运行, torch 线程设置和峰值内存互不干扰
+    try:
+        workers = setting["workers"]
+        if workers == 1:
+            _init_worker(model_name, setting["threads"])
+            shard_results = [_run_shard(image_paths, setting["batch_size"], setting["preprocess"])]
+        else:
+            shards = [image_paths[i::workers] for i in range(workers)]
+            with ProcessPoolExecutor(max_workers=workers, mp_context=mp.get_context("spawn"),
+                                     initializer=_init_worker,
+                                     initargs=(model_name, setting["threads"])) as pool:
+                shard_results = list(pool.map(_run_shard, shards,
+                                              [setting["batch_size"]] * workers,
+                                              [setting["preprocess"]] * workers))
+
+        processed = sum(r[0] for r in shard_results)
+        # 各工作进程并行处理, 以最慢的分片作为总耗时
+        elapsed = max(r[1] for r in shard_results)
+        stage_ms = {}
+        for _, _, timings in shard_results:
+            for stage, seconds in timings.items():
+                stage_ms[stage] = stage_ms.get(stage, 0.0) + seconds
+        stage_ms = {stage: seconds * 1000 / max(processed, 1) for stage, seconds in stage_ms.items()}
+
+        result = dict(setting)
+        result.update({
+            "images": processed,
+            "seconds": elapsed,
+            "images_per_sec": processed / elapsed if elapsed > 0 else 0.0,
+            "stage_ms_per_image": stage_ms,
+            "peak_rss_mb": peak_rss_mb(resource.RUSAGE_SELF) if resource else None,
+            "peak_rss_mb_worker": peak_rss_mb(resource.RUSAGE_CHILDREN) if resource and workers > 1 else None,
+        })
+        result_queue.put(result)
+    except Exception as e:
+        result_queue.put({**setting, "error": str(e)})
+
+
+def run_setting_in_subprocess(setting: dict, image_paths: list[str], model_name: str) -> dict:
+    ctx = mp.get_context("spawn")
+    result_queue = ctx.Queue()
+    process = ctx.Process(target=_run_setting, args=(setting, image_paths, model_name, result_queue))
+    process.start()
+    result = None
+    while result is None:
+        try:
+            result = result_queue.get(timeout=1)
+        except Exception:
+            if not process.is_alive():
+                result = {**setting, "error": f"子进程异常退出, 退出码 {process.exitcode}"}
+    process.join()
+    return result
+
+
+def setting_key(result: dict) -> tuple:
+    return (result["batch_size"], result["threads"], result["preprocess"], result["workers"])
+
+
+def compare_with_baseline(results: list[dict], baseline_path: str, tolerance: float) -> list[str]:
+    with open(baseline_path, 'r', encoding='utf-8') as f:
+        baseline = {setting_key(r): r for r in json.load(f)["results"] if "error" not in r}
+    regressions = []
+    for result in results:
+        label = (f"batch={result['batch_size']} threads={result['threads']} "
+                 f"preprocess={result['preprocess']} workers={result['workers']}")
+        if "error" in result:
+            # 出错的配置没有吞吐量数据, 视为回归, 否则一次崩溃会让 CI 误判为通过
+            regressions.append(f"{label}: 运行出错 ({result['error']})")
+            continue
+        base = baseline.get(setting_key(result))
+        if base is None:
+            continue
+        if result["images_per_sec"] < base["images_per_sec"] * (1 - tolerance):
+            regressions.append(f"{label}: {result['images_per_sec']:.2f} img/s < 基线 {base['images_per_sec']:.2f} img/s")
+    run_keys = {setting_key(r) for r in results}
+    for key in baseline:
+        if key not in run_keys:
+            batch_size, threads, preprocess, workers = key
+            regressions.append(f"batch={batch_size} threads={threads} preprocess={preprocess} workers={workers}: "
+                               f"基线中的配置未在本次运行中测量")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="ViTFeatureExtractor 特征提取吞吐量基准测试")
+    parser.add_argument("--batch-sizes", default="1,8,32", help="逗号分隔的 batch 大小")
+    parser.add_argument("--threads", default=f"1,{os.cpu_count()}", help="逗号分隔的 torch intra-op 线程数")
+    parser.add_argument("--preprocess", default="processor,numpy", help="逗号分隔的预处理方式 (processor, numpy)")
+    parser.add_argument("--workers", default="1,2", help="逗号分隔的工作进程数")
+    parser.add_argument("--images", type=int, default=96, help="每个配置处理的合成图像数")
+    parser.add_argument("--resolutions", default=DEFAULT_RESOLUTIONS, help="逗号分隔的合成图像分辨率 (宽x高)")
+    parser.add_argument("--formats", default=DEFAULT_FORMATS, help="逗号分隔的合成图像格式")
+    parser.add_argument("--model", default=VIT_MODEL_NAME, help="模型名称")
+    parser.add_argument("--output", default="benchmark_extractor.json", help="结果 JSON 输出路径")
+    parser.add_argument("--baseline", help="基线 JSON 路径, 吞吐量低于基线超过容差时以非零状态退出")
+    parser.add_argument("--tolerance", type=float, default=0.10, help="允许的吞吐量下降比例")
+    args = parser.parse_args()
+
+    settings = [{"batch_size": b, "threads": t, "preprocess": p, "workers": w}
+                for b, t, p, w in product(parse_int_list(args.batch_sizes), parse_int_list(args.threads),
+                                          parse_str_list(args.preprocess), parse_int_list(args.workers))]
+    print(f"--- 特征提取基准测试: {len(settings)} 个配置, 每个配置 {args.images} 张合成图像 ---")
+
+    results = []
+    with tempfile.TemporaryDirectory(prefix="vit_bench_") as image_dir:
+        gen_start = time.time()
+        image_paths = generate_synthetic_images(image_dir, args.images, parse_str_list(args.resolutions),
+                                                parse_str_list(args.formats))
+        print(f"  [计时] 生成合成图像耗时: {time.time() - gen_start:.4f} 秒")
+
+        for setting in settings:
+            result = run_setting_in_subprocess(setting, image_paths, args.model)
+            results.append(result)
+            if "error" in result:
+                print(f"[错误] {setting}: {result['error']}")
+                continue
+            stages = ", ".join(f"{stage} {ms:.2f}ms" for stage, ms in result["stage_ms_per_image"].items())
+            rss = f"{result['peak_rss_mb']:.0f} MB" if result["peak_rss_mb"] is not None else "N/A"
+            print(f"batch={setting['batch_size']:<3} threads={setting['threads']:<3} "
+                  f"preprocess={setting['preprocess']:<9} workers={setting['workers']}: "
+                  f"{result['images_per_sec']:.2f} img/s | {stages} | 峰值 RSS {rss}")
+
+    report = {
+        "meta": {
+            "model": args.model,
+            "images_per_setting": args.images,
+            "resolutions": parse_str_list(args.resolutions),
+            "formats": parse_str_list(args.formats),
+            "cpu_count": os.cpu_count(),
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        },
+        "results": results,
+    }
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"结果已写入 {args.output}")
+
+    if args.baseline:
+        regressions = compare_with_baseline(results, args.baseline, args.tolerance)
+        if regressions:
+            print(f"[失败] 相对基线 {args.baseline} 出现吞吐量下降、运行出错或缺失的配置 (容差 {args.tolerance:.0%}):")
+            for line in regressions:
+                print(f"  {line}")
+            sys.exit(1)
+        print(f"[成功] 所有配置均未低于基线 {args.baseline} (容差 {args.tolerance:.0%})。")
+    elif any("error" in r for r in results):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,30 @@
+# build_knn_graph.py
+import argparse
+import time
+from core.config import INDEX_PATH, MAPPING_PATH, KNN_GRAPH_K, KNN_GRAPH_BLOCK_SIZE, KNN_GRAPH_THREADS
+from core.knn_graph import build_knn_graph
+from core.searcher import apply_search_params
+from core.snapshot import read_index, read_index_meta, resolve_index_paths
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="为当前索引快照离线构建 top-K 近邻图")
+    parser.add_argument("--k", type=int, default=KNN_GRAPH_K, help="每个向量保存的近邻数")
+    parser.add_argument("--block-size", type=int, default=KNN_GRAPH_BLOCK_SIZE, help="每个线程一次计算的向量数")
+    parser.add_argument("--threads", type=int, default=KNN_GRAPH_THREADS, help="并行线程数")
+    args = parser.parse_args()
+
+    overall_start_time = time.time()
+    index_path, _, version = resolve_index_paths(INDEX_PATH, MAPPING_PATH)
+    print(f"[信息] 正在加载索引 {index_path} (版本: {version or '未版本化'})")
+    try:
+        index = read_index(index_path)
+        # 与搜索器使用相同的 nprobe / 调优参数, 否则 IVF 索引按默认 nprobe = 1 建图, 近邻质量很差
+        apply_search_params(index, read_index_meta(index_path))
+        new_version = build_knn_graph(index, INDEX_PATH, MAPPING_PATH, version,
+                                      k=args.k, block_size=args.block_size, num_threads=args.threads)
+    except Exception as e:
+        print(f"[错误] 构建近邻图失败: {e}")
+        exit(1)
+    if new_version is not None:
+        print(f"[成功] 近邻图已发布为快照 {new_version}，正在运行的 main_app.py 会自动热加载。")
+    print(f"[成功] 近邻图构建完成。总耗时: {time.time() - overall_start_time:.2f} 秒。")
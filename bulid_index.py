@@ -2,9 +2,14 @@
 import os
 import time # 导入 time 模块
 from core.config import (DATA_DIR, INDEX_PATH, MAPPING_PATH, VIT_MODEL_NAME,
-                         FEATURE_DIM, FAISS_INDEX_TYPE_CPU, INDEX_DIR)
+                         FEATURE_DIM, FAISS_INDEX_TYPE_CPU, INDEX_DIR,
+                         PCA_OUTPUT_DIM, PCA_WHITEN, BUILD_KNN_GRAPH, BUILD_RESOURCE_MODE)
 from core.feature_extractor import ViTFeatureExtractor
 from core.indexer import FaissIndexer
+from core.knn_graph import build_knn_graph
+from core.resources import apply_thread_budget
+from core.searcher import apply_search_params
+from core.snapshot import get_snapshot_dir, read_index_meta, resolve_index_paths
 
 if __name__ == "__main__":
     print("-" * 60)
@@ -12,6 +17,7 @@ if __name__ == "__main__":
     print("-" * 60)
 
     overall_start_time = time.time()
+    thread_budget = apply_thread_budget(BUILD_RESOURCE_MODE)
 
     print(f"[信息] 确保索引目录存在: {INDEX_DIR}")
     os.makedirs(INDEX_DIR, exist_ok=True)
@@ -27,7 +33,8 @@ if __name__ == "__main__":
     print(f"\n[步骤 1/4] 初始化 ViT 特征提取器 ({VIT_MODEL_NAME})...")
     step1_start_time = time.time()
     try:
-        feature_extractor = ViTFeatureExtractor(model_name=VIT_MODEL_NAME)
+        feature_extractor = ViTFeatureExtractor(model_name=VIT_MODEL_NAME,
+                                                decode_workers=thread_budget["decode_workers"])
         print("[成功] 特征提取器初始化完成。")
     except Exception as e:
         print(f"[错误] 初始化特征提取器失败: {e}")
@@ -37,10 +44,11 @@ if __name__ == "__main__":
 
 
     # --- 步骤 2: 初始化 Faiss 索引器 ---
-    print(f"\n[步骤 2/4] 初始化 Faiss 索引器 (CPU类型: {FAISS_INDEX_TYPE_CPU}, 维度: {FEATURE_DIM})...")
+    pca_info = f", PCA 降维: {PCA_OUTPUT_DIM}{' (白化)' if PCA_WHITEN else ''}" if PCA_OUTPUT_DIM else ""
+    print(f"\n[步骤 2/4] 初始化 Faiss 索引器 (CPU类型: {FAISS_INDEX_TYPE_CPU}, 维度: {FEATURE_DIM}{pca_info})...")
     step2_start_time = time.time()
     try:
-        indexer = FaissIndexer(feature_dim=FEATURE_DIM)
+        indexer = FaissIndexer(feature_dim=FEATURE_DIM, pca_dim=PCA_OUTPUT_DIM, pca_whiten=PCA_WHITEN)
         print("[成功] Faiss 索引器初始化完成。")
     except Exception as e:
         print(f"[错误] 初始化 Faiss 索引器失败: {e}")
@@ -69,9 +77,13 @@ if __name__ == "__main__":
     print("\n[步骤 4/4] 保存 CPU 索引和映射文件...")
     step4_start_time = time.time()
     try:
-        indexer.save_index(INDEX_PATH, MAPPING_PATH)
-        print(f"[成功] CPU 索引保存至: {INDEX_PATH}")
-        print(f"          映射文件保存至: {MAPPING_PATH}")
+        version = indexer.save_index(INDEX_PATH, MAPPING_PATH)
+        print(f"[成功] 索引快照 {version} 已发布至: {get_snapshot_dir(INDEX_DIR, version)}")
+        print("          正在运行的 main_app.py 会自动热加载该版本。")
+        if BUILD_KNN_GRAPH:
+            index_path, _, _ = resolve_index_paths(INDEX_PATH, MAPPING_PATH)
+            apply_search_params(indexer.index_cpu, read_index_meta(index_path))
+            build_knn_graph(indexer.index_cpu, INDEX_PATH, MAPPING_PATH, version)
     except Exception as e:
         print(f"[错误] 保存索引或映射失败: {e}")
         exit(1)
@@ -7,6 +7,39 @@ DATA_DIR = os.path.join(BASE_DIR, "data")
 INDEX_DIR = os.path.join(BASE_DIR, "index")
 INDEX_PATH = os.path.join(INDEX_DIR, "image_features.index")
 MAPPING_PATH = os.path.join(INDEX_DIR, "image_paths.pkl")
+# 每次保存索引都会在 index/snapshots/<版本号>/ 下写入一份完整快照 (索引 + 路径映射),
+# 写完后再原子地更新 index/CURRENT 指针文件, 读取方永远只会看到成对一致的索引和映射。
+SNAPSHOT_KEEP = 3 # 保留最近几个快照版本 (含当前版本), 更早的会被清理
+INDEX_RELOAD_POLL_SECONDS = 5.0 # 运行中的搜索器检查新快照的间隔
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.gif')
+
+# --- 实时入库配置 ---
+# main_app.py 运行期间监视 DATA_DIR, 新图片写入完成后提取特征并追加到正在服务的索引中;
+# 追加前先写入预写日志 (WAL), 日志积累到一定大小 (或超过最长间隔) 时把内存中的索引发布为新快照后清空日志。
+# 每次发布都要序列化并写出完整索引, 不宜频繁进行; 未发布的记录在重启时从日志回放, 不会丢失
+INGEST_ENABLED = True
+INGEST_POLL_SECONDS = 1.0 # 目录轮询间隔 (目录修改时间未变化时只做一次 stat)
+INGEST_DEBOUNCE_SECONDS = 1.0 # 文件大小和修改时间保持不变多久才视为写入完成
+INGEST_BATCH_SIZE = 16 # 每个微批次提取特征的图像数
+INGEST_FLUSH_WAL_MB = 64 # 预写日志达到此大小时刷写为索引快照 (768 维向量约 2 万条)
+INGEST_FLUSH_SECONDS = 3600.0 # 日志未达到上述大小时, 最长隔多久也刷写一次
+WAL_PATH = os.path.join(INDEX_DIR, "ingest.wal")
+
+# --- 多图库配置 ---
+# 一个进程内托管多个图库, 共享同一个 ViT 特征提取器。名称 -> 索引目录 (目录结构与 INDEX_DIR 相同)
+DEFAULT_COLLECTION = "default"
+COLLECTIONS = {DEFAULT_COLLECTION: INDEX_DIR}
+COLLECTION_RAM_BUDGET_MB = 4096 # 已加载图库 (索引 + 路径映射) 的内存预算, 超出时按 LRU 卸载
+
+# --- CPU 线程预算 ---
+# torch 与 Faiss (OpenMP) 在同一进程中运行, 按运行模式为二者及图像解码线程分配明确的线程数, 避免相互争抢 CPU
+# 模式: "interactive" (界面单次查询), "service" (多个并发查询), "build" (批量构建索引)
+APP_RESOURCE_MODE = "interactive"
+BUILD_RESOURCE_MODE = "build"
+SERVICE_CONCURRENCY = 4 # service 模式下同时处理的查询数
+CPU_AFFINITY = None # 可选: 进程绑定的 CPU 编号列表, 例如 list(range(8)); 仅 Linux 支持
+BUILD_BATCH_SIZE = 32 # 构建索引时每批提取特征的图像数
 
 # --- 模型配置 ---
 VIT_MODEL_NAME = "google/vit-base-patch16-224-in21k"
@@ -14,11 +47,36 @@ FEATURE_DIM = 768
 
 # --- Faiss 配置 ---
 # 构建和保存时使用CPU索引 (IndexFlatIP 用于余弦相似度)
+# 可选: "IndexFlatIP", "IndexFlatL2", "IndexHNSWFlat" (内积),
+#       "IVFFlatOnDisk" (倒排列表保存在磁盘文件中并内存映射, 用于超出内存的图库)
 FAISS_INDEX_TYPE_CPU = "IndexFlatIP"
+HNSW_M = 32 # HNSW 每个节点的邻居数
+# 搜索参数 (nprobe / efSearch) 可用 tune_index.py 自动调优, 结果写入快照目录的元数据文件, 加载时自动应用
+INDEX_META_NAME = "index_meta.json"
+
+# --- IVF / 磁盘倒排列表配置 ---
+IVF_NLIST = 1024 # 倒排列表 (聚类中心) 数量
+IVF_NPROBE = 16 # 搜索时访问的倒排列表数量
+IVF_TRAIN_SIZE = 100000 # 训练粗量化器最多使用的样本数 (取自第一批)
+ONDISK_SHARD_SIZE = 100000 # 磁盘模式下每一遍提取并写入分片的图像数, 决定构建时的峰值内存
+IVF_DATA_NAME = "image_features.ivfdata" # 合并后的倒排列表文件名, 与索引文件放在同一目录
+
+# --- PCA 降维配置 ---
+# 构建时训练 PCA (可选白化) 并与索引一起保存, 查询时自动应用同一变换。None 表示不降维 (保留 FEATURE_DIM 维)
+PCA_OUTPUT_DIM = None # 例如 128 或 256
+PCA_WHITEN = False # True 时按特征值做白化 (eigen_power=-0.5)
+PCA_EVAL_QUERIES = 500 # 构建结束时用于比较降维前后召回率/速度的采样查询数
 
 # --- 搜索配置 ---
 K_RESULTS = 5 # 返回结果数量
 
+# --- 近邻图配置 ---
+# 离线为每个已索引向量预先计算 top-K 近邻, 以 int32/float16 的 .npy 文件与索引快照放在一起, 搜索器按需内存映射
+KNN_GRAPH_K = 20
+KNN_GRAPH_BLOCK_SIZE = 4096 # 每个线程一次计算的向量数
+KNN_GRAPH_THREADS = os.cpu_count() or 1
+BUILD_KNN_GRAPH = False # 为 True 时 bulid_index.py 保存快照后立即构建近邻图
+
 # --- GUI 配置 ---
 QUERY_IMG_DISPLAY_SIZE = 224
 RESULT_IMG_DISPLAY_SIZE = 150
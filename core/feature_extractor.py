@@ -4,10 +4,17 @@ from PIL import Image
 from transformers import ViTImageProcessor, ViTModel
 import numpy as np
 import time # 导入 time 模块
+from concurrent.futures import ThreadPoolExecutor
+
+# 预处理路径: "processor" 使用 Hugging Face ViTImageProcessor; "numpy" 为等价的精简实现 (双线性缩放 + mean/std 标准化)
+PREPROCESS_MODES = ("processor", "numpy")
+TIMING_STAGES = ("decode", "preprocess", "forward", "normalize")
 
 class ViTFeatureExtractor:
-    def __init__(self, model_name="google/vit-base-patch16-224-in21k"):
+    def __init__(self, model_name="google/vit-base-patch16-224-in21k", decode_workers: int = 1):
         init_start_time = time.time() # 开始计时
+        # 批量提取时用线程池并行解码图像 (PIL 解码期间释放 GIL); 线程数由 core.resources 的线程预算决定
+        self.decode_pool = ThreadPoolExecutor(decode_workers, thread_name_prefix="decode") if decode_workers > 1 else None
         self.device = "cuda" if torch.cuda.is_available() else "cpu"
         print(f"特征提取器：使用设备 - {self.device}")
 
@@ -40,4 +47,57 @@ class ViTFeatureExtractor:
             return normalized_features.flatten()
         except Exception as e:
             print(f"错误：处理图像 {image_path} 时出错: {e}")
-            return None
\ No newline at end of file
+            return None
+
+    @staticmethod
+    def _decode(image_path: str) -> Image.Image | None:
+        try:
+            return Image.open(image_path).convert("RGB")
+        except Exception as e:
+            print(f"错误：处理图像 {image_path} 时出错: {e}")
+            return None
+
+    def _preprocess(self, images: list, mode: str) -> torch.Tensor:
+        if mode == "processor":
+            return self.processor(images=images, return_tensors="pt")["pixel_values"].to(self.device)
+        elif mode == "numpy":
+            size = (self.processor.size["width"], self.processor.size["height"])
+            mean = np.asarray(self.processor.image_mean, dtype=np.float32)
+            std = np.asarray(self.processor.image_std, dtype=np.float32)
+            batch = np.stack([np.asarray(img.resize(size, Image.BILINEAR), dtype=np.float32) for img in images])
+            batch = (batch / 255.0 - mean) / std
+            return torch.from_numpy(np.ascontiguousarray(batch.transpose(0, 3, 1, 2))).to(self.device)
+        else:
+            raise ValueError(f"不支持的预处理方式: {mode}，可选: {PREPROCESS_MODES}")
+
+    @torch.no_grad()
+    def extract_features_batch(self, image_paths: list[str], preprocess: str = "processor",
+                               timings: dict | None = None) -> tuple[np.ndarray, list[str]]:
+        """批量提取特征，返回 (特征矩阵, 成功处理的路径)。timings 不为 None 时按阶段累加耗时 (秒)。"""
+        decode_start = time.perf_counter()
+        if self.decode_pool is not None:
+            decoded = list(self.decode_pool.map(self._decode, image_paths))
+        else:
+            decoded = [self._decode(image_path) for image_path in image_paths]
+        images = [img for img in decoded if img is not None]
+        valid_paths = [path for path, img in zip(image_paths, decoded) if img is not None]
+        if not images:
+            return np.empty((0, self.model.config.hidden_size), dtype='float32'), []
+
+        preprocess_start = time.perf_counter()
+        pixel_values = self._preprocess(images, preprocess)
+        forward_start = time.perf_counter()
+        outputs = self.model(pixel_values=pixel_values)
+        features = outputs.last_hidden_state[:, 0, :].cpu().numpy() # .cpu() 会等待 GPU 计算完成
+        normalize_start = time.perf_counter()
+        norm = np.linalg.norm(features, axis=1, keepdims=True)
+        normalized_features = (features / (norm + 1e-6)).astype('float32')
+        normalize_end = time.perf_counter()
+
+        if timings is not None:
+            for stage, elapsed in zip(TIMING_STAGES, (preprocess_start - decode_start,
+                                                      forward_start - preprocess_start,
+                                                      normalize_start - forward_start,
+                                                      normalize_end - normalize_start)):
+                timings[stage] = timings.get(stage, 0.0) + elapsed
+        return normalized_features, valid_paths
\ No newline at end of file
@@ -3,32 +3,63 @@ import faiss
 import numpy as np
 import os
 import pickle
+import shutil
+import tempfile
 from tqdm import tqdm
 from .feature_extractor import ViTFeatureExtractor
-from .config import FAISS_INDEX_TYPE_CPU
+from .config import (FAISS_INDEX_TYPE_CPU, K_RESULTS, PCA_EVAL_QUERIES, INDEX_DIR, IVF_NLIST, IVF_NPROBE,
+                     IVF_TRAIN_SIZE, ONDISK_SHARD_SIZE, IVF_DATA_NAME, HNSW_M, BUILD_BATCH_SIZE)
+from .snapshot import read_index, resolve_index_paths, write_snapshot
 import time # 导入 time 模块
 
 class FaissIndexer:
-    def __init__(self, feature_dim: int):
+    def __init__(self, feature_dim: int, pca_dim: int | None = None, pca_whiten: bool = False):
         init_start_time = time.time() # 开始计时
         self.feature_dim = feature_dim
-        if FAISS_INDEX_TYPE_CPU == "IndexFlatIP":
-             self.index_cpu = faiss.IndexFlatIP(self.feature_dim)
-        elif FAISS_INDEX_TYPE_CPU == "IndexFlatL2":
-             self.index_cpu = faiss.IndexFlatL2(self.feature_dim)
+        if pca_dim is not None and not (0 < pca_dim < feature_dim):
+            raise ValueError(f"PCA 输出维度必须在 1 到 {feature_dim - 1} 之间, 得到 {pca_dim}")
+        self.pca_dim = pca_dim
+        self.pca_whiten = pca_whiten
+        self.index_cpu = self._create_index()
+        if self.pca_dim:
+            print(f"初始化 Faiss CPU 索引 (类型: {FAISS_INDEX_TYPE_CPU}, 维度: {self.feature_dim} -> PCA{'+白化' if self.pca_whiten else ''} {self.pca_dim})")
         else:
-            raise ValueError(f"不支持的 CPU 索引类型: {FAISS_INDEX_TYPE_CPU}")
-        print(f"初始化 Faiss CPU 索引 (类型: {FAISS_INDEX_TYPE_CPU}, 维度: {self.feature_dim})")
+            print(f"初始化 Faiss CPU 索引 (类型: {FAISS_INDEX_TYPE_CPU}, 维度: {self.feature_dim})")
         self.image_paths = []
+        self.reduction_report = None
+        self.is_on_disk = FAISS_INDEX_TYPE_CPU == "IVFFlatOnDisk"
+        self._work_dir = None # 磁盘模式下存放分片和合并后倒排列表的临时目录
         init_end_time = time.time() # 结束计时
         print(f"  [计时] FaissIndexer __init__ 耗时: {init_end_time - init_start_time:.4f} 秒")
 
+    def _create_base_index(self, dim: int):
+        if FAISS_INDEX_TYPE_CPU == "IndexFlatIP":
+            return faiss.IndexFlatIP(dim)
+        elif FAISS_INDEX_TYPE_CPU == "IndexFlatL2":
+            return faiss.IndexFlatL2(dim)
+        elif FAISS_INDEX_TYPE_CPU == "IndexHNSWFlat":
+            return faiss.IndexHNSWFlat(dim, HNSW_M, faiss.METRIC_INNER_PRODUCT)
+        elif FAISS_INDEX_TYPE_CPU == "IVFFlatOnDisk":
+            # 先在内存中构建, 合并阶段再把倒排列表替换为磁盘文件 (OnDiskInvertedLists)
+            return faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, IVF_NLIST, faiss.METRIC_INNER_PRODUCT)
+        else:
+            raise ValueError(f"不支持的 CPU 索引类型: {FAISS_INDEX_TYPE_CPU}")
+
+    def _create_index(self):
+        if not self.pca_dim:
+            return self._create_base_index(self.feature_dim)
+        # PCA 变换作为 IndexPreTransform 的一部分写入同一个索引文件, 搜索时 Faiss 会自动对查询向量做相同投影。
+        # 投影后重新做 L2 归一化, 保证内积仍等价于余弦相似度。
+        eigen_power = -0.5 if self.pca_whiten else 0.0
+        pca = faiss.PCAMatrix(self.feature_dim, self.pca_dim, eigen_power)
+        norm = faiss.NormalizationTransform(self.pca_dim, 2.0)
+        index = faiss.IndexPreTransform(norm, self._create_base_index(self.pca_dim))
+        index.prepend_transform(pca)
+        return index
 
     def build_index(self, image_folder: str, feature_extractor: ViTFeatureExtractor):
         # build_index 内部有 tqdm 进度条，可以大致了解特征提取时间
         # 这里主要关注 Faiss add 的时间
-        all_features = []
-        valid_image_paths = []
         try:
             image_files = [os.path.join(image_folder, f)
                            for f in os.listdir(image_folder)
@@ -43,40 +74,175 @@ class FaissIndexer:
 
         print(f"在 {image_folder} 中找到 {len(image_files)} 张图片。开始提取特征...")
 
-        for img_path in tqdm(image_files, desc="提取特征中"):
-            features = feature_extractor.extract_features(img_path)
-            if features is not None:
-                all_features.append(features)
-                valid_image_paths.append(img_path)
+        if self.is_on_disk:
+            self._build_on_disk(image_files, feature_extractor)
+            return
 
-        if not all_features:
+        features_np, valid_image_paths = self._extract_features(image_files, feature_extractor)
+        if features_np is None:
             print("错误：未能成功提取任何特征，无法构建索引。")
             return
 
-        features_np = np.array(all_features).astype('float32')
-        if features_np.shape[1] != self.feature_dim:
-             raise ValueError(f"特征维度不匹配: 期望 {self.feature_dim}, 得到 {features_np.shape[1]}")
-
         print(f"提取了 {features_np.shape[0]} 个特征。正在构建 Faiss CPU 索引...")
+        self._train(features_np)
         add_start_time = time.time()
         self.index_cpu.add(features_np)
         add_end_time = time.time()
         print(f"  [计时] Faiss index_cpu.add 耗时: {add_end_time - add_start_time:.4f} 秒")
         self.image_paths = valid_image_paths
         print(f"Faiss CPU 索引构建成功，包含 {self.index_cpu.ntotal} 个向量。")
+        if self.pca_dim:
+            self.reduction_report = self.report_reduction(features_np)
+
+    def _extract_features(self, image_files: list[str], feature_extractor: ViTFeatureExtractor,
+                          desc: str = "提取特征中") -> tuple[np.ndarray | None, list[str]]:
+        all_features = []
+        valid_image_paths = []
+        with tqdm(total=len(image_files), desc=desc) as progress:
+            for start in range(0, len(image_files), BUILD_BATCH_SIZE):
+                batch_files = image_files[start:start + BUILD_BATCH_SIZE]
+                features, batch_paths = feature_extractor.extract_features_batch(batch_files)
+                if batch_paths:
+                    all_features.append(features)
+                    valid_image_paths.extend(batch_paths)
+                progress.update(len(batch_files))
+        if not all_features:
+            return None, []
+        features_np = np.concatenate(all_features).astype('float32')
+        if features_np.shape[1] != self.feature_dim:
+             raise ValueError(f"特征维度不匹配: 期望 {self.feature_dim}, 得到 {features_np.shape[1]}")
+        return features_np, valid_image_paths
+
+    def _train(self, features_np: np.ndarray):
+        if self.index_cpu.is_trained:
+            return
+        min_samples = max(self.pca_dim or 0, IVF_NLIST if self.is_on_disk else 0)
+        if features_np.shape[0] < min_samples:
+            raise ValueError(f"训练索引 (PCA/IVF) 需要至少 {min_samples} 个样本, 当前只有 {features_np.shape[0]} 个")
+        train_start_time = time.time()
+        self.index_cpu.train(features_np[:IVF_TRAIN_SIZE] if self.is_on_disk else features_np)
+        train_end_time = time.time()
+        print(f"  [计时] 索引训练 (PCA/IVF) 耗时: {train_end_time - train_start_time:.4f} 秒")
+
+    def _build_on_disk(self, image_files: list[str], feature_extractor: ViTFeatureExtractor):
+        # 分多遍构建: 每遍只提取 ONDISK_SHARD_SIZE 张图像, 加入已训练的空索引副本后写成分片文件并释放内存;
+        # 最后把所有分片的倒排列表合并到一个内存映射的 .ivfdata 文件中。
+        from faiss.contrib.ondisk import merge_ondisk
+
+        self._cleanup_work_dir()
+        os.makedirs(INDEX_DIR, exist_ok=True)
+        self._work_dir = tempfile.mkdtemp(prefix="ivf_build_", dir=INDEX_DIR)
+        shard_paths = []
+        image_paths = []
+        num_shards = (len(image_files) + ONDISK_SHARD_SIZE - 1) // ONDISK_SHARD_SIZE
+        trained_bytes = None # 训练后的空索引, 每个分片从它反序列化出一份副本
+        for shard_no, start in enumerate(range(0, len(image_files), ONDISK_SHARD_SIZE)):
+            features_np, shard_image_paths = self._extract_features(
+                image_files[start:start + ONDISK_SHARD_SIZE], feature_extractor,
+                desc=f"提取特征中 (第 {shard_no + 1}/{num_shards} 遍)")
+            if features_np is None:
+                continue
+            self._train(features_np)
+            if trained_bytes is None:
+                # 不用 faiss.clone_index: PCA 链中的 NormalizationTransform 不支持克隆
+                trained_bytes = faiss.serialize_index(self.index_cpu)
+            shard_index = faiss.deserialize_index(trained_bytes)
+            # 使用全局连续 id, 合并后 id 即为 image_paths 中的位置
+            ids = np.arange(len(image_paths), len(image_paths) + features_np.shape[0], dtype='int64')
+            shard_index.add_with_ids(features_np, ids)
+            shard_path = os.path.join(self._work_dir, f"shard_{shard_no:04d}.index")
+            faiss.write_index(shard_index, shard_path)
+            if self.pca_dim and not shard_paths:
+                # 全部特征不会同时驻留内存, 以第一个分片为样本评估降维效果
+                faiss.ParameterSpace().set_index_parameter(shard_index, "nprobe", IVF_NPROBE)
+                self.reduction_report = self.report_reduction(features_np, index=shard_index)
+            shard_paths.append(shard_path)
+            image_paths.extend(shard_image_paths)
+            del shard_index, features_np
+            print(f"  已写入分片 {shard_path} (累计 {len(image_paths)} 个向量)")
+
+        if not shard_paths:
+            print("错误：未能成功提取任何特征，无法构建索引。")
+            self._cleanup_work_dir()
+            return
+
+        print(f"正在合并 {len(shard_paths)} 个分片的倒排列表到磁盘文件...")
+        merge_start_time = time.time()
+        ivfdata_path = os.path.join(self._work_dir, IVF_DATA_NAME)
+        merge_ondisk(self.index_cpu, shard_paths, ivfdata_path)
+        merge_end_time = time.time()
+        print(f"  [计时] 倒排列表合并耗时: {merge_end_time - merge_start_time:.4f} 秒")
+        for shard_path in shard_paths:
+            os.remove(shard_path)
+        self.image_paths = image_paths
+        print(f"Faiss 磁盘倒排索引构建成功，包含 {self.index_cpu.ntotal} 个向量。")
+
+    def _cleanup_work_dir(self):
+        if self._work_dir is not None:
+            shutil.rmtree(self._work_dir, ignore_errors=True)
+            self._work_dir = None
+
+    def report_reduction(self, features_np: np.ndarray, k: int = K_RESULTS, index=None) -> dict:
+        """以全维度精确索引为基准, 报告降维索引的大小、单次查询耗时和 recall@k。
+
+        index 默认为 self.index_cpu, 须恰好包含 features_np 中的向量 (id 与行号一致)。
+        """
+        index = self.index_cpu if index is None else index
+        n = features_np.shape[0]
+        k = min(k, n - 1)
+        rng = np.random.default_rng(0)
+        query_ids = rng.choice(n, min(PCA_EVAL_QUERIES, n), replace=False)
+        queries = features_np[query_ids]
+
+        def drop_self(ids: np.ndarray) -> np.ndarray:
+            # 查询取自被索引的向量, 多取一个结果并去掉自身, 否则自身在两边都会被算作命中, recall 虚高
+            is_self = ids == query_ids[:, None]
+            order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+            return np.take_along_axis(ids, order, axis=1)
+
+        full_index = faiss.IndexFlat(self.feature_dim, self.index_cpu.metric_type)
+        full_index.add(features_np)
+
+        full_start = time.time()
+        _, gt_ids = full_index.search(queries, k + 1)
+        gt_ids = drop_self(gt_ids)
+        full_ms = (time.time() - full_start) * 1000 / len(queries)
+        reduced_start = time.time()
+        _, reduced_ids = index.search(queries, k + 1)
+        reduced_ms = (time.time() - reduced_start) * 1000 / len(queries)
+        reduced_ids = drop_self(reduced_ids)
+
+        hits = sum(len(set(gt_row) & set(reduced_row)) for gt_row, reduced_row in zip(gt_ids, reduced_ids))
+        report = {
+            "full_dim": self.feature_dim,
+            "reduced_dim": self.pca_dim,
+            "whiten": self.pca_whiten,
+            "full_size_bytes": int(faiss.serialize_index(full_index).nbytes),
+            "reduced_size_bytes": int(faiss.serialize_index(index).nbytes),
+            "full_ms_per_query": full_ms,
+            "reduced_ms_per_query": reduced_ms,
+            f"recall@{k}": hits / (len(queries) * k),
+        }
+        print(f"PCA 降维评估 ({len(queries)} 个采样查询, 以 {self.feature_dim} 维精确索引为基准):")
+        print(f"  索引大小: {report['full_size_bytes'] / 2**20:.2f} MB -> {report['reduced_size_bytes'] / 2**20:.2f} MB")
+        print(f"  单次查询耗时: {full_ms:.4f} ms -> {reduced_ms:.4f} ms")
+        print(f"  recall@{k}: {report[f'recall@{k}']:.4f}")
+        return report
 
     def save_index(self, index_path: str, mapping_path: str):
         if not hasattr(self.index_cpu, 'ntotal') or self.index_cpu.ntotal == 0:
             print("索引为空，不执行保存。")
             return
-        print(f"正在保存 Faiss CPU 索引到 {index_path}")
-        faiss.write_index(self.index_cpu, index_path)
-        print(f"正在保存图像路径映射到 {mapping_path}")
-        with open(mapping_path, 'wb') as f:
-            pickle.dump(self.image_paths, f)
+        if not self.is_on_disk:
+            return write_snapshot(self.index_cpu, self.image_paths, index_path, mapping_path)
+        version = write_snapshot(self.index_cpu, self.image_paths, index_path, mapping_path,
+                                 extra_files=[os.path.join(self._work_dir, IVF_DATA_NAME)])
+        self._cleanup_work_dir()
+        return version
 
     def load_index(self, index_path: str, mapping_path: str) -> bool:
         load_total_start = time.time()
+        index_path, mapping_path, _ = resolve_index_paths(index_path, mapping_path)
         if not os.path.exists(index_path):
             print(f"错误：索引文件未找到: {index_path}")
             return False
@@ -87,7 +253,7 @@ class FaissIndexer:
         try:
             print(f"正在从 {index_path} 加载 Faiss CPU 索引")
             read_index_start = time.time()
-            self.index_cpu = faiss.read_index(index_path)
+            self.index_cpu = read_index(index_path)
             read_index_end = time.time()
             print(f"  [计时] faiss.read_index 耗时: {read_index_end - read_index_start:.4f} 秒")
 
@@ -0,0 +1,210 @@
+# core/ingest.py
+import os
+import struct
+import threading
+import time
+import numpy as np
+from .config import (IMAGE_EXTENSIONS, INGEST_POLL_SECONDS, INGEST_DEBOUNCE_SECONDS, INGEST_BATCH_SIZE,
+                     INGEST_FLUSH_SECONDS, INGEST_FLUSH_WAL_MB, WAL_PATH)
+from .feature_extractor import ViTFeatureExtractor
+from .resources import apply_faiss_threads
+from .searcher import FaissSearcher
+
+_WAL_HEADER = struct.Struct("<II") # 路径字节数, 向量维度
+_MTIME_RACY_NS = 2_000_000_000 # 目录修改时间与扫描时间相差小于此值时, 同一时间刻度内可能还有未扫描到的新文件
+
+
+class WriteAheadLog:
+    # 记录格式: [路径字节数 u32][维度 u32][UTF-8 路径][float32 向量]; 每次追加后 fsync,
+    # 进程崩溃时末尾可能残留半条记录, 回放时忽略即可
+    def __init__(self, wal_path: str = WAL_PATH):
+        self.wal_path = wal_path
+        self.num_records = 0
+        self.num_bytes = 0
+
+    def append(self, image_paths: list[str], features: np.ndarray):
+        with open(self.wal_path, 'ab') as f:
+            for image_path, vector in zip(image_paths, features):
+                path_bytes = image_path.encode('utf-8')
+                f.write(_WAL_HEADER.pack(len(path_bytes), vector.shape[0]))
+                f.write(path_bytes)
+                f.write(np.asarray(vector, dtype='<f4').tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+            self.num_bytes = f.tell()
+        self.num_records += len(image_paths)
+
+    def replay(self) -> tuple[list[str], np.ndarray | None]:
+        if not os.path.exists(self.wal_path):
+            return [], None
+        with open(self.wal_path, 'rb') as f:
+            data = f.read()
+        image_paths, vectors = [], []
+        offset = 0
+        while offset + _WAL_HEADER.size <= len(data):
+            path_len, dim = _WAL_HEADER.unpack_from(data, offset)
+            end = offset + _WAL_HEADER.size + path_len + dim * 4
+            if end > len(data):
+                print(f"入库：预写日志末尾有不完整的记录 ({len(data) - offset} 字节)，已忽略。")
+                break
+            path_start = offset + _WAL_HEADER.size
+            image_paths.append(data[path_start:path_start + path_len].decode('utf-8'))
+            vectors.append(np.frombuffer(data, dtype='<f4', count=dim, offset=path_start + path_len))
+            offset = end
+        self.num_records = len(image_paths)
+        self.num_bytes = len(data)
+        return image_paths, (np.stack(vectors).astype('float32') if vectors else None)
+
+    def truncate(self):
+        with open(self.wal_path, 'wb') as f:
+            f.flush()
+            os.fsync(f.fileno())
+        self.num_records = 0
+        self.num_bytes = 0
+
+
+class LiveIngestor:
+    def __init__(self, feature_extractor: ViTFeatureExtractor, searcher: FaissSearcher, data_dir: str,
+                 wal_path: str = WAL_PATH, poll_interval: float = INGEST_POLL_SECONDS,
+                 debounce: float = INGEST_DEBOUNCE_SECONDS, batch_size: int = INGEST_BATCH_SIZE,
+                 flush_interval: float = INGEST_FLUSH_SECONDS, flush_wal_mb: float = INGEST_FLUSH_WAL_MB):
+        self.feature_extractor = feature_extractor
+        self.searcher = searcher
+        self.data_dir = data_dir
+        self.wal = WriteAheadLog(wal_path)
+        self.poll_interval = poll_interval
+        self.debounce = debounce
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.flush_wal_bytes = int(flush_wal_mb * 2**20)
+        self._pending = {} # 路径 -> (大小, 修改时间, 首次观察到该状态的时间)
+        self._failed = {} # 提取失败的路径 -> (大小, 修改时间), 文件变化后才会重试
+        self._dir_mtime = None
+        self._seen_version = None
+        self._last_flush = time.time()
+        self._thread = None
+        self._stop = threading.Event()
+
+    def start(self) -> bool:
+        if not self.searcher.supports_live_add():
+            print("入库：当前索引不支持实时追加，未启动目录监视。")
+            return False
+        if self._thread is not None and self._thread.is_alive():
+            return True
+        self._replay_wal()
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._run, name="LiveIngestor", daemon=True)
+        self._thread.start()
+        print(f"入库：开始监视 {self.data_dir} (轮询 {self.poll_interval} 秒, 去抖 {self.debounce} 秒)。")
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout=30)
+            self._thread = None
+        # 未刷写的记录保留在预写日志中, 下次启动时回放
+
+    def _replay_wal(self):
+        image_paths, features = self.wal.replay()
+        if not image_paths:
+            return
+        keep = [i for i, path in enumerate(image_paths) if self.searcher.get_id_for_path(path) is None]
+        if keep:
+            self.searcher.add_vectors(features[keep], [image_paths[i] for i in keep])
+        print(f"入库：从预写日志恢复 {len(keep)} 个向量 (日志共 {len(image_paths)} 条)。")
+
+    def _run(self):
+        apply_faiss_threads()
+        while not self._stop.wait(self.poll_interval):
+            try:
+                self._poll_once()
+                if self._should_flush():
+                    self.flush()
+            except Exception as e:
+                print(f"入库：处理新图像时出错: {e}")
+
+    def _should_flush(self) -> bool:
+        # 发布快照要序列化并写出完整索引: 按日志大小触发, 时间间隔只作为兜底
+        if not self.wal.num_records:
+            return False
+        return (self.wal.num_bytes >= self.flush_wal_bytes
+                or time.time() - self._last_flush >= self.flush_interval)
+
+    @staticmethod
+    def _file_state(path: str) -> tuple[int, int] | None:
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return stat.st_size, stat.st_mtime_ns
+
+    def _scan_candidates(self) -> list[os.DirEntry] | None:
+        # 目录修改时间未变、没有待定文件且索引版本未变时跳过整目录扫描, 每轮只需一次 stat。
+        # 原地改写文件不会改变目录的修改时间, 提取失败的文件需要单独 stat, 变化后才能重试
+        dir_mtime = os.stat(self.data_dir).st_mtime_ns
+        version = self.searcher.version
+        failed_changed = any(self._file_state(path) != state for path, state in self._failed.items())
+        if (dir_mtime == self._dir_mtime and version == self._seen_version and not self._pending
+                and not failed_changed):
+            return None # 跳过扫描
+        # 扫描时刻与目录修改时间落在同一时间刻度内时, 之后创建的文件可能不改变目录修改时间, 下一轮仍需扫描
+        self._dir_mtime = dir_mtime if time.time_ns() - dir_mtime >= _MTIME_RACY_NS else None
+        self._seen_version = version
+        with os.scandir(self.data_dir) as entries:
+            return [entry for entry in entries
+                    if entry.is_file() and entry.name.lower().endswith(IMAGE_EXTENSIONS)
+                    and self.searcher.get_id_for_path(entry.path) is None]
+
+    def _poll_once(self):
+        now = time.time()
+        ready = []
+        seen = set()
+        candidates = self._scan_candidates()
+        if candidates is None:
+            return
+        for entry in candidates:
+            seen.add(entry.path)
+            stat = entry.stat()
+            state = (stat.st_size, stat.st_mtime_ns)
+            failed = self._failed.get(entry.path)
+            if failed == state:
+                continue
+            if failed is not None:
+                del self._failed[entry.path] # 文件已变化, 重新去抖后重试
+            pending = self._pending.get(entry.path)
+            if pending is None or pending[:2] != state:
+                self._pending[entry.path] = (*state, now)
+            elif now - pending[2] >= self.debounce:
+                ready.append(entry.path)
+        # 已被删除或已入库的文件不再等待
+        for path in [p for p in self._pending if p not in seen]:
+            del self._pending[path]
+        for path in [p for p in self._failed if p not in seen]:
+            del self._failed[path] # 已删除或已入库
+
+        for start in range(0, len(ready), self.batch_size):
+            self._ingest_batch(ready[start:start + self.batch_size])
+
+    def _ingest_batch(self, image_paths: list[str]):
+        batch_start = time.time()
+        features, valid_paths = self.feature_extractor.extract_features_batch(image_paths)
+        for path in image_paths:
+            state = self._pending.pop(path, None)
+            if path not in valid_paths and state is not None:
+                self._failed[path] = state[:2]
+        if not valid_paths:
+            return
+        self.wal.append(valid_paths, features) # 先落盘, 再对搜索可见
+        ntotal = self.searcher.add_vectors(features, valid_paths)
+        print(f"入库：新增 {len(valid_paths)} 张图像，索引共 {ntotal} 个向量。  [计时] 微批次耗时: {time.time() - batch_start:.4f} 秒")
+
+    def flush(self):
+        if not self.wal.num_records:
+            return
+        flush_start = time.time()
+        version = self.searcher.save_snapshot()
+        if version is not None:
+            self.wal.truncate()
+            print(f"入库：预写日志已刷写为索引快照 {version}。  [计时] 刷写耗时: {time.time() - flush_start:.4f} 秒")
+        self._last_flush = time.time()
@@ -0,0 +1,124 @@
+# core/knn_graph.py
+import os
+import pickle
+import time
+from concurrent.futures import ThreadPoolExecutor
+import faiss
+import numpy as np
+from .config import KNN_GRAPH_K, KNN_GRAPH_BLOCK_SIZE, KNN_GRAPH_THREADS
+from .snapshot import get_snapshot_dir, read_index_meta, republish_snapshot, resolve_index_paths
+
+KNN_IDS_NAME = "knn_graph_ids.npy"
+KNN_SCORES_NAME = "knn_graph_scores.npy"
+
+
+def get_graph_paths(index_path: str) -> tuple[str, str]:
+    graph_dir = os.path.dirname(index_path)
+    return os.path.join(graph_dir, KNN_IDS_NAME), os.path.join(graph_dir, KNN_SCORES_NAME)
+
+
+def load_knn_graph(index_path: str) -> tuple[np.ndarray, np.ndarray] | None:
+    ids_path, scores_path = get_graph_paths(index_path)
+    if not os.path.exists(ids_path) or not os.path.exists(scores_path):
+        return None
+    # 内存映射, 只有被访问到的行才会被读入内存
+    return np.load(ids_path, mmap_mode='r'), np.load(scores_path, mmap_mode='r')
+
+
+def enable_reconstruct(index):
+    # IVF 索引需要 id -> (列表, 偏移) 的直接映射才能按 id 取回向量
+    try:
+        index_ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return
+    if index_ivf.direct_map.no():
+        index_ivf.make_direct_map()
+
+
+def vector_index(index):
+    # PCA 索引直接在降维后的子索引上取回向量并计算近邻: 避免反投影再正投影,
+    # 且白化后的 PCA 不可逆, IndexPreTransform.reconstruct 会直接失败
+    if isinstance(index, faiss.IndexPreTransform):
+        index = faiss.downcast_index(index.index)
+    enable_reconstruct(index)
+    return index
+
+
+def _read_image_paths(index_path: str, mapping_path: str, version: str) -> list[str]:
+    snapshot_dir = get_snapshot_dir(os.path.dirname(index_path), version)
+    with open(os.path.join(snapshot_dir, os.path.basename(mapping_path)), 'rb') as f:
+        return pickle.load(f)
+
+
+def _publish_knn_graph(index_path: str, mapping_path: str, version: str, source_paths: list[str],
+                       ids_tmp: str, scores_tmp: str) -> str:
+    # 已发布的快照不再修改: 近邻图连同当前快照的其余文件一起发布为新版本, 正在运行的搜索器会热加载它。
+    # 构建期间实时入库可能已发布更新的快照; 只要它是在原快照基础上追加得到的 (前 n 个路径一致), 近邻图对它依然有效
+    current_index_path, _, current = resolve_index_paths(index_path, mapping_path)
+    if current != version:
+        current_paths = _read_image_paths(index_path, mapping_path, current)
+        if current_paths[:len(source_paths)] != source_paths:
+            raise RuntimeError(f"构建近邻图期间索引已被重建 (当前版本 {current})，请重新运行 build_knn_graph.py。")
+        print(f"构建期间发布了新快照 {current}，近邻图将发布到该版本之上。")
+    return republish_snapshot(os.path.dirname(index_path), current_index_path, read_index_meta(current_index_path),
+                              extra_files={KNN_IDS_NAME: ids_tmp, KNN_SCORES_NAME: scores_tmp})
+
+
+def build_knn_graph(index, index_path: str, mapping_path: str, version: str | None, k: int = KNN_GRAPH_K,
+                    block_size: int = KNN_GRAPH_BLOCK_SIZE, num_threads: int = KNN_GRAPH_THREADS) -> str | None:
+    """为快照 version 中的索引 index 构建近邻图并发布为新的快照版本, 返回新版本号。
+
+    index_path / mapping_path 为配置中的路径 (INDEX_PATH / MAPPING_PATH)。未版本化的旧布局直接写在索引文件旁, 返回 None。
+    """
+    build_start = time.time()
+    base = vector_index(index)
+    n = base.ntotal
+    k = min(k, n - 1)
+    if k <= 0:
+        raise ValueError(f"索引只有 {n} 个向量，无法构建近邻图。")
+    source_paths = _read_image_paths(index_path, mapping_path, version) if version is not None else None
+
+    # 临时文件写在索引目录下, 而不是已发布的快照目录中 (后者可能在构建期间被清理)
+    index_dir = os.path.dirname(index_path)
+    ids_tmp = os.path.join(index_dir, f"{KNN_IDS_NAME}.tmp{os.getpid()}.npy")
+    scores_tmp = os.path.join(index_dir, f"{KNN_SCORES_NAME}.tmp{os.getpid()}.npy")
+    ids = scores = None
+
+    def process_block(start: int):
+        # 并行由分块线程池负责, 关闭 Faiss 内部的 OpenMP 并行, 避免线程过度订阅;
+        # OpenMP 线程数按线程生效, 必须在工作线程中设置
+        faiss.omp_set_num_threads(1)
+        end = min(start + block_size, n)
+        vectors = base.reconstruct_n(start, end - start)
+        distances, neighbors = base.search(vectors, k + 1)
+        # 去掉每行中的自身; 若自身因重复向量未出现在结果中, 则丢弃最后一个
+        is_self = neighbors == np.arange(start, end)[:, None]
+        order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+        ids[start:end] = np.take_along_axis(neighbors, order, axis=1)
+        scores[start:end] = np.take_along_axis(distances, order, axis=1)
+
+    print(f"正在构建近邻图 ({n} 个向量, top-{k}, 块大小 {block_size}, {num_threads} 线程)...")
+    try:
+        ids = np.lib.format.open_memmap(ids_tmp, mode='w+', dtype=np.int32, shape=(n, k))
+        scores = np.lib.format.open_memmap(scores_tmp, mode='w+', dtype=np.float16, shape=(n, k))
+        with ThreadPoolExecutor(max_workers=num_threads) as pool:
+            list(pool.map(process_block, range(0, n, block_size)))
+        ids.flush()
+        scores.flush()
+        ids = scores = None # 释放内存映射, Windows 下才能重命名文件
+
+        if version is None:
+            ids_path, scores_path = get_graph_paths(index_path)
+            os.replace(ids_tmp, ids_path)
+            os.replace(scores_tmp, scores_path)
+            print(f"近邻图已保存到 {ids_path} 和 {scores_path}")
+            new_version = None
+        else:
+            new_version = _publish_knn_graph(index_path, mapping_path, version, source_paths, ids_tmp, scores_tmp)
+    finally:
+        ids = scores = None
+        for tmp_path in (ids_tmp, scores_tmp):
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    print(f"  [计时] 近邻图构建耗时: {time.time() - build_start:.4f} 秒")
+    return new_version
@@ -0,0 +1,125 @@
+# core/registry.py
+import os
+import threading
+import time
+from collections import OrderedDict
+import numpy as np
+from .config import INDEX_PATH, MAPPING_PATH, COLLECTIONS, COLLECTION_RAM_BUDGET_MB
+from .feature_extractor import ViTFeatureExtractor
+from .searcher import FaissSearcher
+
+
+class CollectionRegistry:
+    # 在一个进程中托管多个图库: 所有图库共享同一个特征提取器, 索引在首次查询时加载,
+    # 总内存超出预算时按最近最少使用 (LRU) 的顺序卸载。被卸载的搜索器在进行中的搜索结束后由引用计数释放。
+    def __init__(self, feature_extractor: ViTFeatureExtractor, collections: dict[str, str] = COLLECTIONS,
+                 ram_budget_mb: float = COLLECTION_RAM_BUDGET_MB):
+        self.feature_extractor = feature_extractor
+        self.collections = dict(collections)
+        self.ram_budget_bytes = int(ram_budget_mb * 2**20)
+        self._searchers = OrderedDict() # 名称 -> FaissSearcher, 最近使用的在末尾
+        self._sizes = {}
+        self._pinned = set()
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.collections}
+        self.stats = {name: {"loads": 0, "hits": 0, "evictions": 0, "load_seconds": 0.0, "bytes": 0}
+                      for name in self.collections}
+
+    def names(self) -> list[str]:
+        return list(self.collections)
+
+    def is_loaded(self, name: str) -> bool:
+        with self._lock:
+            return name in self._searchers
+
+    def pin(self, name: str):
+        # 固定的图库不会被卸载 (例如正在实时入库的图库)
+        self._pinned.add(name)
+
+    def get_searcher(self, name: str) -> FaissSearcher:
+        if name not in self.collections:
+            raise KeyError(f"未知的图库: {name}，可选: {self.names()}")
+        searcher = self._lookup(name)
+        if searcher is not None:
+            return searcher
+        # 同一图库的并发首次查询只加载一次; 不同图库可以并行加载
+        with self._load_locks[name]:
+            searcher = self._lookup(name)
+            if searcher is not None:
+                return searcher
+            index_dir = self.collections[name]
+            print(f"图库注册表：正在加载图库 '{name}' ({index_dir})...")
+            load_start = time.time()
+            searcher = FaissSearcher(index_path=os.path.join(index_dir, os.path.basename(INDEX_PATH)),
+                                     mapping_path=os.path.join(index_dir, os.path.basename(MAPPING_PATH)))
+            if searcher.get_active_index() is None:
+                raise RuntimeError(f"加载图库 '{name}' 的索引失败，请检查目录 {index_dir}。")
+            searcher.start_watching()
+            load_seconds = time.time() - load_start
+            size = searcher.estimate_memory_bytes()
+            self._refresh_sizes()
+            with self._lock:
+                self._searchers[name] = searcher
+                self._sizes[name] = size
+                stats = self.stats[name]
+                stats["loads"] += 1
+                stats["load_seconds"] += load_seconds
+                stats["bytes"] = size
+                evicted = self._evict_over_budget(keep=name)
+            # 停止监视线程需要 join, 在锁外进行, 不阻塞其它图库的查询
+            for evicted_searcher in evicted:
+                evicted_searcher.stop_watching()
+            print(f"图库注册表：图库 '{name}' 加载完成 ({size / 2**20:.1f} MB)。  [计时] 加载耗时: {load_seconds:.4f} 秒")
+            return searcher
+
+    def _lookup(self, name: str) -> FaissSearcher | None:
+        with self._lock:
+            searcher = self._searchers.get(name)
+            if searcher is not None:
+                self._searchers.move_to_end(name)
+                self.stats[name]["hits"] += 1
+            return searcher
+
+    def _refresh_sizes(self):
+        # 热加载和实时入库会改变已加载图库的大小, 比较预算前重新估算; 估算需遍历路径列表, 在锁外进行
+        with self._lock:
+            searchers = list(self._searchers.items())
+        sizes = [(name, searcher, searcher.estimate_memory_bytes()) for name, searcher in searchers]
+        with self._lock:
+            for name, searcher, size in sizes:
+                if self._searchers.get(name) is searcher:
+                    self._sizes[name] = size
+                    self.stats[name]["bytes"] = size
+
+    def _evict_over_budget(self, keep: str) -> list[FaissSearcher]:
+        # 调用方需持有 self._lock; 返回被卸载的搜索器, 由调用方在释放锁之后停止其监视线程
+        evicted = []
+        for name in list(self._searchers):
+            if sum(self._sizes.values()) <= self.ram_budget_bytes:
+                break
+            if name == keep or name in self._pinned:
+                continue
+            evicted.append(self._searchers.pop(name))
+            self._sizes.pop(name)
+            self.stats[name]["evictions"] += 1
+            print(f"图库注册表：内存超出预算 ({self.ram_budget_bytes / 2**20:.0f} MB)，已卸载图库 '{name}'。")
+        return evicted
+
+    def search(self, name: str, query_feature: np.ndarray, k: int = 10) -> list[tuple[str, float]]:
+        return self.get_searcher(name).search(query_feature, k)
+
+    def get_stats(self) -> dict:
+        with self._lock:
+            return {name: {**stats, "loaded": name in self._searchers, "pinned": name in self._pinned}
+                    for name, stats in self.stats.items()}
+
+    def get_memory_usage_bytes(self) -> int:
+        self._refresh_sizes()
+        with self._lock:
+            return sum(self._sizes.values())
+
+    def close(self):
+        with self._lock:
+            searchers = list(self._searchers.values())
+        for searcher in searchers:
+            searcher.stop_watching()
@@ -0,0 +1,84 @@
+# core/resources.py
+import os
+import threading
+from contextlib import contextmanager
+import faiss
+import torch
+from .config import SERVICE_CONCURRENCY, CPU_AFFINITY
+
+RESOURCE_MODES = ("interactive", "service", "build")
+
+_query_slots = None # service 模式下限制并发查询数的信号量
+_faiss_threads = None # 当前线程预算中的 Faiss OpenMP 线程数
+
+
+def available_cpus() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def plan_thread_budget(mode: str, cpus: int | None = None, concurrency: int = SERVICE_CONCURRENCY) -> dict:
+    cpus = cpus or available_cpus()
+    if mode == "interactive":
+        # 单次查询中特征提取与搜索先后执行, 二者共用同一半核心; 另一半留给界面线程和后台入库
+        half = max(1, cpus // 2)
+        budget = {"torch_intra_op": half, "torch_inter_op": 1, "faiss_omp": half,
+                  "decode_workers": 1, "max_concurrent_queries": 1}
+    elif mode == "service":
+        # 多个查询并发: 每个查询分到 cpus / 并发数 个 torch 线程, 单条查询的 Faiss 搜索不再开 OpenMP 并行
+        concurrency = max(1, min(concurrency, cpus))
+        budget = {"torch_intra_op": max(1, cpus // concurrency), "torch_inter_op": 1, "faiss_omp": 1,
+                  "decode_workers": concurrency, "max_concurrent_queries": concurrency}
+    elif mode == "build":
+        # 批量构建: 少量解码线程为前向计算供图, 其余核心给 torch; Faiss 训练/添加在特征提取之后进行, 可用全部核心
+        decode_workers = max(1, cpus // 4)
+        budget = {"torch_intra_op": max(1, cpus - decode_workers), "torch_inter_op": 1, "faiss_omp": cpus,
+                  "decode_workers": decode_workers, "max_concurrent_queries": 1}
+    else:
+        raise ValueError(f"不支持的资源模式: {mode}，可选: {RESOURCE_MODES}")
+    budget["mode"] = mode
+    budget["cpus"] = cpus
+    return budget
+
+
+def apply_thread_budget(mode: str, cpu_affinity: list[int] | None = CPU_AFFINITY,
+                        concurrency: int = SERVICE_CONCURRENCY) -> dict:
+    global _query_slots, _faiss_threads
+    if cpu_affinity:
+        if hasattr(os, "sched_setaffinity"):
+            os.sched_setaffinity(0, cpu_affinity)
+        else:
+            print("资源配置：当前平台不支持设置 CPU 亲和性，已忽略 CPU_AFFINITY。")
+    budget = plan_thread_budget(mode, concurrency=concurrency)
+    torch.set_num_threads(budget["torch_intra_op"])
+    try:
+        torch.set_num_interop_threads(budget["torch_inter_op"])
+    except RuntimeError as e:
+        # inter-op 线程池只能在第一次并行计算之前设置一次
+        print(f"资源配置：无法设置 torch inter-op 线程数 ({e})，保持当前值 {torch.get_num_interop_threads()}。")
+    _faiss_threads = budget["faiss_omp"]
+    apply_faiss_threads()
+    _query_slots = threading.BoundedSemaphore(budget["max_concurrent_queries"])
+    print(f"资源配置：模式 {mode}，可用 CPU {budget['cpus']} 个 -> torch intra-op {budget['torch_intra_op']}, "
+          f"inter-op {budget['torch_inter_op']}, Faiss OpenMP {budget['faiss_omp']}, "
+          f"解码线程 {budget['decode_workers']}, 并发查询上限 {budget['max_concurrent_queries']}")
+    return budget
+
+
+def apply_faiss_threads():
+    # omp_set_num_threads 只对调用它的线程生效, 执行 Faiss 搜索/追加的每个工作线程启动时都需调用一次;
+    # 未调用 apply_thread_budget 时保持 Faiss 默认值
+    if _faiss_threads is not None:
+        faiss.omp_set_num_threads(_faiss_threads)
+
+
+@contextmanager
+def query_slot():
+    # 未调用 apply_thread_budget 时不做限制
+    slots = _query_slots
+    if slots is None:
+        yield
+        return
+    with slots:
+        yield
@@ -3,99 +3,318 @@ import faiss
 import numpy as np
 import pickle
 import os
+import sys
 import time
-from .config import FAISS_INDEX_TYPE_CPU
+import threading
+from contextlib import contextmanager
+from .config import FAISS_INDEX_TYPE_CPU, INDEX_RELOAD_POLL_SECONDS, IVF_NPROBE, DATA_DIR
+from .knn_graph import get_graph_paths, load_knn_graph, vector_index
+from .snapshot import read_current_version, read_index, read_index_meta, resolve_index_paths, write_snapshot
+
+def is_ivf_index(index) -> bool:
+    try:
+        faiss.extract_index_ivf(index)
+        return True
+    except RuntimeError:
+        return False
+
+
+def is_on_disk_index(index) -> bool:
+    if not is_ivf_index(index):
+        return False
+    invlists = faiss.downcast_InvertedLists(faiss.extract_index_ivf(index).invlists)
+    return isinstance(invlists, faiss.OnDiskInvertedLists)
+
+
+def image_path_key(image_path: str, data_dir: str = DATA_DIR) -> str:
+    """判断图像是否已入库时使用的路径键。
+
+    映射文件中保存的是构建索引时的绝对路径, 换一台机器、换检出目录或盘符大小写不同时字符串并不相等。
+    位于数据目录 (按目录名匹配) 之下的路径取其相对部分, 再统一分隔符和大小写 (os.path.normcase)。
+    """
+    path = image_path.replace('\\', '/')
+    marker = '/' + os.path.basename(os.path.normpath(data_dir)) + '/'
+    pos = path.rfind(marker)
+    if pos >= 0:
+        path = path[pos + len(marker):]
+    else:
+        path = os.path.abspath(path).replace('\\', '/')
+    return os.path.normcase(path)
+
+
+def apply_search_params(index, meta: dict):
+    # IVF 索引默认 nprobe 为 1, 先设为配置值; 快照元数据中有 tune_index.py 调优得到的搜索参数时再覆盖
+    if is_ivf_index(index):
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", IVF_NPROBE)
+    if meta.get("search_params"):
+        faiss.ParameterSpace().set_index_parameters(index, meta["search_params"])
+
+
+class _ReadWriteLock:
+    # 读写锁: 多个搜索可以同时读取索引, 追加向量时独占; 有写者等待时不再放行新的读者, 避免实时入库被持续的查询饿死
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._readers = 0
+        self._writer = False
+        self._writers_waiting = 0
+
+    @contextmanager
+    def read_locked(self):
+        with self._cond:
+            while self._writer or self._writers_waiting:
+                self._cond.wait()
+            self._readers += 1
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._readers -= 1
+                if self._readers == 0:
+                    self._cond.notify_all()
+
+    @contextmanager
+    def write_locked(self):
+        with self._cond:
+            self._writers_waiting += 1
+            while self._writer or self._readers:
+                self._cond.wait()
+            self._writers_waiting -= 1
+            self._writer = True
+        try:
+            yield
+        finally:
+            with self._cond:
+                self._writer = False
+                self._cond.notify_all()
+
+
+class _LoadedIndex:
+    # 一个已加载的索引快照。搜索时先取出当前快照的引用再使用, 热替换只需替换 FaissSearcher._loaded,
+    # 旧快照在所有仍持有引用的搜索结束后由引用计数自动释放。
+    def __init__(self, version, index_path, index_cpu, index_gpu, image_paths, meta=None):
+        self.version = version
+        self.index_path = index_path
+        self.index_cpu = index_cpu
+        self.index_gpu = index_gpu
+        self.image_paths = image_paths
+        self.meta = meta or {}
+        self.knn_graph = load_knn_graph(index_path)
+        self._path_ids = None
+        # Faiss CPU 索引的搜索可以并发, 但不能与追加同时进行
+        self.lock = _ReadWriteLock()
+
+    def get_knn_graph(self):
+        # 未版本化的旧布局中近邻图在加载之后原地生成, 这里按需补加载 (快照布局下新近邻图以新版本发布, 由热加载载入)
+        if self.knn_graph is None:
+            self.knn_graph = load_knn_graph(self.index_path)
+        return self.knn_graph
+
+    def get_id_for_path(self, image_path: str) -> int | None:
+        if self._path_ids is None:
+            with self.lock.write_locked():
+                if self._path_ids is None:
+                    self._path_ids = {image_path_key(path): i for i, path in enumerate(self.image_paths)}
+        return self._path_ids.get(image_path_key(image_path))
+
+    def add(self, features_np: np.ndarray, image_paths: list[str]):
+        with self.lock.write_locked():
+            self.index_cpu.add(features_np)
+            if self.index_gpu is not None:
+                self.index_gpu.add(features_np)
+            start_id = len(self.image_paths)
+            self.image_paths.extend(image_paths)
+            if self._path_ids is not None:
+                self._path_ids.update((image_path_key(path), start_id + i) for i, path in enumerate(image_paths))
+
+    @property
+    def is_gpu_enabled(self) -> bool:
+        return self.index_gpu is not None
+
+    def get_active_index(self):
+        return self.index_gpu if self.index_gpu is not None else self.index_cpu
+
 
 class FaissSearcher:
     def __init__(self, index_path: str, mapping_path: str):
         init_start_time = time.time() # 开始计时
         self.index_path = index_path
         self.mapping_path = mapping_path
-        self.index_cpu = None
-        self.index_gpu = None
         self.gpu_resource = None
-        self.image_paths = None
-        self.is_gpu_enabled = False
+        self._loaded = None
+        self._reload_lock = threading.Lock()
+        self._failed_version = None
+        self._watch_thread = None
+        self._stop_watching = threading.Event()
         self._load_and_init_gpu()
         init_end_time = time.time() # 结束计时
         print(f"  [计时] FaissSearcher __init__ (含 _load_and_init_gpu) 总耗时: {init_end_time - init_start_time:.4f} 秒")
 
+    @property
+    def version(self):
+        return self._loaded.version if self._loaded else None
+
+    @property
+    def index_cpu(self):
+        return self._loaded.index_cpu if self._loaded else None
+
+    @property
+    def index_gpu(self):
+        return self._loaded.index_gpu if self._loaded else None
+
+    @property
+    def image_paths(self):
+        return self._loaded.image_paths if self._loaded else None
+
+    @property
+    def is_gpu_enabled(self) -> bool:
+        return self._loaded.is_gpu_enabled if self._loaded else False
 
     def _load_and_init_gpu(self):
-        load_total_start = time.time()
-        if not os.path.exists(self.index_path) or not os.path.exists(self.mapping_path):
-            print(f"错误：索引文件 ({self.index_path}) 或映射文件 ({self.mapping_path}) 未找到。请先构建索引。")
+        index_path, mapping_path, version = resolve_index_paths(self.index_path, self.mapping_path)
+        loaded = self._load_snapshot(index_path, mapping_path, version)
+        if loaded is None:
             return False
+        self._loaded = loaded
+        return True
+
+    def _load_snapshot(self, index_path: str, mapping_path: str, version: str | None) -> _LoadedIndex | None:
+        load_total_start = time.time()
+        if not os.path.exists(index_path) or not os.path.exists(mapping_path):
+            print(f"错误：索引文件 ({index_path}) 或映射文件 ({mapping_path}) 未找到。请先构建索引。")
+            return None
         try:
-            print(f"搜索器：正在从 {self.index_path} 加载 Faiss CPU 索引...")
+            print(f"搜索器：正在从 {index_path} 加载 Faiss CPU 索引 (版本: {version or '未版本化'})...")
             read_index_start = time.time()
-            self.index_cpu = faiss.read_index(self.index_path)
+            index_cpu = read_index(index_path)
             read_index_end = time.time()
             print(f"  [计时] faiss.read_index 耗时: {read_index_end - read_index_start:.4f} 秒")
-            print(f"搜索器：CPU 索引加载成功，包含 {self.index_cpu.ntotal} 个向量，维度 {self.index_cpu.d}。")
+            print(f"搜索器：CPU 索引加载成功，包含 {index_cpu.ntotal} 个向量，维度 {index_cpu.d}。")
+            on_disk = is_on_disk_index(index_cpu)
+            meta = read_index_meta(index_path)
+            # 在转移到 GPU 之前设置搜索参数, 克隆时会一并复制
+            apply_search_params(index_cpu, meta)
+            if is_ivf_index(index_cpu):
+                print(f"搜索器：IVF 索引{' (倒排列表内存映射自磁盘)' if on_disk else ''}，nprobe = {IVF_NPROBE}。")
+            if meta.get("search_params"):
+                print(f"搜索器：已应用调优的搜索参数 {meta['search_params']}。")
 
-            print(f"搜索器：正在从 {self.mapping_path} 加载图像路径映射...")
+            print(f"搜索器：正在从 {mapping_path} 加载图像路径映射...")
             pickle_load_start = time.time()
-            with open(self.mapping_path, 'rb') as f:
-                self.image_paths = pickle.load(f)
+            with open(mapping_path, 'rb') as f:
+                image_paths = pickle.load(f)
             pickle_load_end = time.time()
             print(f"  [计时] pickle.load 耗时: {pickle_load_end - pickle_load_start:.4f} 秒")
+            if len(image_paths) != index_cpu.ntotal:
+                raise ValueError(f"映射条目数 ({len(image_paths)}) 与索引向量数 ({index_cpu.ntotal}) 不一致")
             print("搜索器：图像路径映射加载成功。")
 
             print("搜索器：尝试将索引转移到 GPU...")
             gpu_init_total_start = time.time()
+            index_gpu = None
             try:
-                if faiss.get_num_gpus() > 0:
+                if on_disk:
+                    # 磁盘倒排列表无法转移到 GPU; 依靠操作系统页缓存按需换入, 内存不足时只会变慢而不会失败
+                    print("搜索器：磁盘倒排索引仅支持 CPU 搜索。")
+                elif faiss.get_num_gpus() > 0:
                     print(f"搜索器：检测到 {faiss.get_num_gpus()} 个 GPU。正在使用 GPU 0...")
-                    
-                    gpu_res_start = time.time()
-                    self.gpu_resource = faiss.StandardGpuResources()
-                    gpu_res_end = time.time()
-                    print(f"    [计时] faiss.StandardGpuResources() 耗时: {gpu_res_end - gpu_res_start:.4f} 秒")
+
+                    if self.gpu_resource is None:
+                        gpu_res_start = time.time()
+                        self.gpu_resource = faiss.StandardGpuResources()
+                        gpu_res_end = time.time()
+                        print(f"    [计时] faiss.StandardGpuResources() 耗时: {gpu_res_end - gpu_res_start:.4f} 秒")
 
                     cpu_to_gpu_start = time.time()
-                    self.index_gpu = faiss.index_cpu_to_gpu(self.gpu_resource, 0, self.index_cpu)
+                    index_gpu = self._index_cpu_to_gpu(index_cpu)
                     cpu_to_gpu_end = time.time()
                     print(f"    [计时] faiss.index_cpu_to_gpu 耗时: {cpu_to_gpu_end - cpu_to_gpu_start:.4f} 秒")
-                    
-                    self.is_gpu_enabled = True
+
                     print("搜索器：索引已成功转移到 GPU。将使用 GPU 进行搜索。")
                 else:
                     print("搜索器：未检测到可用 GPU。将使用 CPU 进行搜索。")
-                    self.is_gpu_enabled = False
             except AttributeError:
                  print("搜索器：当前 Faiss 版本似乎不支持 GPU (可能是 faiss-cpu 版本)。将使用 CPU 进行搜索。")
-                 self.is_gpu_enabled = False
+                 index_gpu = None
             except Exception as gpu_e:
                 print(f"搜索器：将索引转移到 GPU 时出错: {gpu_e}。将使用 CPU 进行搜索。")
-                self.is_gpu_enabled = False
+                index_gpu = None
             gpu_init_total_end = time.time()
             print(f"  [计时] GPU 初始化尝试总耗时: {gpu_init_total_end - gpu_init_total_start:.4f} 秒")
 
             load_total_end = time.time()
-            print(f"  [计时] FaissSearcher _load_and_init_gpu 总耗时: {load_total_end - load_total_start:.4f} 秒")
-            return True
+            print(f"  [计时] FaissSearcher _load_snapshot 总耗时: {load_total_end - load_total_start:.4f} 秒")
+            return _LoadedIndex(version, index_path, index_cpu, index_gpu, image_paths, meta)
         except Exception as e:
             print(f"错误：加载索引或映射时发生严重错误: {e}")
-            self.index_cpu = None
-            self.index_gpu = None
-            self.image_paths = None
-            return False
+            return None
+
+    def _index_cpu_to_gpu(self, index_cpu):
+        if not isinstance(index_cpu, faiss.IndexPreTransform):
+            return faiss.index_cpu_to_gpu(self.gpu_resource, 0, index_cpu)
+        # PCA 链中的 NormalizationTransform 不支持克隆, 整体转移会失败; 变换链留在 CPU 上 (与 CPU 索引共享),
+        # 只把降维后的子索引转移到 GPU。新建的 IndexPreTransform 不拥有这些变换, 由 index_cpu 负责释放
+        index_gpu = faiss.IndexPreTransform(
+            faiss.index_cpu_to_gpu(self.gpu_resource, 0, faiss.downcast_index(index_cpu.index)))
+        for i in reversed(range(index_cpu.chain.size())):
+            index_gpu.prepend_transform(index_cpu.chain.at(i))
+        return index_gpu
+
+    def reload(self) -> bool:
+        # 在调用线程中加载新快照, 加载完成后再替换; 替换前后的搜索都不会被阻塞
+        with self._reload_lock:
+            index_path, mapping_path, version = resolve_index_paths(self.index_path, self.mapping_path)
+            if version is None or version == self.version:
+                return False
+            print(f"搜索器：发现新索引快照 {version} (当前: {self.version or '未版本化'})，开始后台加载...")
+            reload_start = time.time()
+            loaded = self._load_snapshot(index_path, mapping_path, version)
+            if loaded is None:
+                self._failed_version = version
+                print(f"搜索器：加载快照 {version} 失败，继续使用当前索引。")
+                return False
+            self._loaded = loaded
+            self._failed_version = None
+            print(f"搜索器：已切换到索引快照 {version}。  [计时] 热加载耗时: {time.time() - reload_start:.4f} 秒")
+            return True
+
+    def start_watching(self, poll_interval: float = INDEX_RELOAD_POLL_SECONDS):
+        if self._watch_thread is not None and self._watch_thread.is_alive():
+            return
+        self._stop_watching.clear()
+        self._watch_thread = threading.Thread(target=self._watch_loop, args=(poll_interval,),
+                                              name="IndexReloadWatcher", daemon=True)
+        self._watch_thread.start()
+        print(f"搜索器：开始监视新索引快照 (每 {poll_interval} 秒检查一次)。")
+
+    def stop_watching(self):
+        self._stop_watching.set()
+        if self._watch_thread is not None:
+            self._watch_thread.join(timeout=5)
+            self._watch_thread = None
+
+    def _watch_loop(self, poll_interval: float):
+        index_dir = os.path.dirname(self.index_path)
+        while not self._stop_watching.wait(poll_interval):
+            version = read_current_version(index_dir)
+            if version is None or version in (self.version, self._failed_version):
+                continue
+            try:
+                self.reload()
+            except Exception as e:
+                print(f"搜索器：热加载索引时出错: {e}")
 
     def get_active_index(self):
-        if self.is_gpu_enabled and self.index_gpu:
-            return self.index_gpu
-        elif self.index_cpu:
-            return self.index_cpu
-        else:
-            return None
+        loaded = self._loaded
+        return loaded.get_active_index() if loaded else None
 
     def search(self, query_feature: np.ndarray, k: int = 10) -> list[tuple[str, float]]:
         # 搜索本身的计时已经在 SearchWorker 中
-        active_index = self.get_active_index()
-        if active_index is None or self.image_paths is None:
+        loaded = self._loaded # 整个搜索过程使用同一个快照, 热替换不会影响进行中的搜索
+        if loaded is None:
             print("错误：索引未成功加载，无法执行搜索。")
             return []
+        active_index = loaded.get_active_index()
+        image_paths = loaded.image_paths
         if active_index.ntotal == 0:
             print("警告：索引为空，无法执行搜索。")
             return []
@@ -104,23 +323,118 @@ class FaissSearcher:
         if query_feature_np.shape[1] != active_index.d:
              raise ValueError(f"查询特征维度 ({query_feature_np.shape[1]}) 与索引维度 ({active_index.d}) 不匹配！")
 
-        print(f"搜索器：使用 {'GPU' if self.is_gpu_enabled else 'CPU'} 执行搜索...")
+        print(f"搜索器：使用 {'GPU' if loaded.is_gpu_enabled else 'CPU'} 执行搜索...")
         # 实际的 active_index.search 计时由 SearchWorker 完成
-        distances, indices = active_index.search(query_feature_np, k)
+        # GPU 索引即使只做搜索也不是线程安全的, 只能独占使用
+        with loaded.lock.write_locked() if loaded.is_gpu_enabled else loaded.lock.read_locked():
+            distances, indices = active_index.search(query_feature_np, k)
 
         results = []
         if indices.size > 0:
             for i, dist in zip(indices[0], distances[0]):
-                if i == -1 or not (0 <= i < len(self.image_paths)):
+                if i == -1 or not (0 <= i < len(image_paths)):
                     print(f"警告：搜索返回无效索引 {i}。")
                     continue
-                results.append((self.image_paths[i], float(dist)))
+                results.append((image_paths[i], float(dist)))
         return results
 
+    def supports_live_add(self) -> bool:
+        loaded = self._loaded
+        # 磁盘倒排列表以只读方式内存映射, 不支持实时追加
+        return loaded is not None and not is_on_disk_index(loaded.index_cpu)
+
+    def add_vectors(self, features: np.ndarray, image_paths: list[str]) -> int:
+        loaded = self._loaded
+        if loaded is None:
+            raise RuntimeError("索引未加载，无法追加向量。")
+        if not self.supports_live_add():
+            raise RuntimeError("当前索引类型 (磁盘倒排列表) 不支持实时追加。")
+        features_np = np.ascontiguousarray(features, dtype='float32').reshape(len(image_paths), -1)
+        loaded.add(features_np, image_paths)
+        return loaded.index_cpu.ntotal
+
+    def save_snapshot(self) -> str | None:
+        # 把当前内存中的索引 (含实时追加的向量) 发布为新快照; 搜索器直接沿用内存中的索引, 不会触发热加载。
+        # 只在读锁内序列化到内存缓冲区, 写盘和 fsync 在释放锁之后进行, 不阻塞实时追加
+        with self._reload_lock:
+            loaded = self._loaded
+            if loaded is None:
+                return None
+            with loaded.lock.read_locked():
+                index_bytes = faiss.serialize_index(loaded.index_cpu)
+                image_paths = list(loaded.image_paths)
+            # 近邻图的 id 空间只增不减, 旧图对已有向量依然有效 (只是不含之后追加的向量), 随快照一并保留;
+            # 追加的向量没有近邻图行, 查询时回退为完整搜索, 重新运行 build_knn_graph.py 可覆盖它们
+            graph_files = [path for path in get_graph_paths(loaded.index_path) if os.path.exists(path)]
+            # 元数据从磁盘重新读取: tune_index.py 可能在加载之后写入了新的搜索参数
+            meta = read_index_meta(loaded.index_path)
+            version = write_snapshot(index_bytes, image_paths, self.index_path, self.mapping_path,
+                                     link_files=graph_files if len(graph_files) == 2 else (), meta=meta)
+            loaded.version = version
+            loaded.index_path, _, _ = resolve_index_paths(self.index_path, self.mapping_path)
+            return version
+
+    def estimate_memory_bytes(self) -> int:
+        # 近似常驻内存: 索引文件大小 (磁盘倒排列表为内存映射, 不计入) + 路径字符串
+        loaded = self._loaded
+        if loaded is None:
+            return 0
+        index_bytes = os.path.getsize(loaded.index_path) if os.path.exists(loaded.index_path) else 0
+        paths_bytes = sys.getsizeof(loaded.image_paths) + sum(sys.getsizeof(p) for p in loaded.image_paths)
+        return index_bytes + paths_bytes
+
+    def get_id_for_path(self, image_path: str) -> int | None:
+        loaded = self._loaded
+        return loaded.get_id_for_path(image_path) if loaded else None
+
+    def get_neighbors(self, index_id: int, k: int = 10) -> list[tuple[str, float]] | None:
+        # O(1) 查表: 直接读取近邻图中第 index_id 行; 未构建近邻图时返回 None
+        loaded = self._loaded
+        if loaded is None:
+            return None
+        graph = loaded.get_knn_graph()
+        if graph is None or not (0 <= index_id < graph[0].shape[0]):
+            return None
+        ids, scores = graph
+        return [(loaded.image_paths[i], float(score))
+                for i, score in zip(ids[index_id, :k], scores[index_id, :k])
+                if 0 <= i < len(loaded.image_paths)]
+
+    def search_neighbors_of_path(self, image_path: str, k: int = 10) -> list[tuple[str, float]]:
+        loaded = self._loaded
+        if loaded is None:
+            return []
+        index_id = loaded.get_id_for_path(image_path)
+        if index_id is None:
+            print(f"警告：{image_path} 不在当前索引中。")
+            return []
+        neighbors = self.get_neighbors(index_id, k)
+        if neighbors is not None:
+            return neighbors
+        # 没有近邻图时回退为一次完整查询: 与 build_knn_graph 相同, 在 PCA 之后的子索引上取回向量并直接搜索, 排除自身
+        print("搜索器：未找到近邻图，回退为完整查询。可运行 build_knn_graph.py 预先计算。")
+        with loaded.lock.write_locked():
+            base = vector_index(loaded.index_cpu) # 首次调用时可能为 IVF 建立直接映射, 需要独占
+        with loaded.lock.read_locked():
+            query_feature = base.reconstruct(index_id).reshape(1, -1)
+            distances, indices = base.search(query_feature, k + 1)
+        return [(loaded.image_paths[i], float(dist)) for i, dist in zip(indices[0], distances[0])
+                if i != index_id and 0 <= i < len(loaded.image_paths)][:k]
+
     def get_index_status(self) -> str:
-        if self.get_active_index():
-            status = f"索引已加载 ({self.get_active_index().ntotal} 向量, 维度 {self.get_active_index().d})。"
-            status += f" 当前使用 {'GPU' if self.is_gpu_enabled else 'CPU'} 进行搜索。"
+        loaded = self._loaded
+        if loaded:
+            active_index = loaded.get_active_index()
+            status = f"索引已加载 ({active_index.ntotal} 向量, 维度 {active_index.d})。"
+            if isinstance(loaded.index_cpu, faiss.IndexPreTransform):
+                status += f" 查询经 PCA 降维至 {loaded.index_cpu.index.d} 维。"
+            if loaded.version:
+                status += f" 快照版本 {loaded.version}。"
+            if loaded.meta.get("search_params"):
+                status += f" 搜索参数 {loaded.meta['search_params']}。"
+            if loaded.knn_graph is not None:
+                status += f" 已加载 top-{loaded.knn_graph[0].shape[1]} 近邻图。"
+            status += f" 当前使用 {'GPU' if loaded.is_gpu_enabled else 'CPU'} 进行搜索。"
             return status
         else:
             return "索引未加载或加载失败。"
\ No newline at end of file
@@ -0,0 +1,191 @@
+# core/snapshot.py
+import json
+import os
+import pickle
+import shutil
+import time
+import faiss
+import numpy as np
+from .config import SNAPSHOT_KEEP, INDEX_META_NAME
+
+CURRENT_POINTER_NAME = "CURRENT"
+SNAPSHOTS_DIR_NAME = "snapshots"
+
+
+def _fsync_file(path: str):
+    with open(path, 'rb') as f:
+        os.fsync(f.fileno())
+
+
+def _fsync_dir(path: str):
+    # 让目录项 (新建文件 / 重命名) 落盘; Windows 不支持打开目录, 跳过即可
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _link_or_copy(source: str, target: str):
+    # 快照中的文件发布后不再修改, 硬链接即可共享; 跨文件系统等不支持硬链接时复制
+    try:
+        os.link(source, target)
+    except OSError:
+        shutil.copy2(source, target)
+
+
+def read_current_version(index_dir: str) -> str | None:
+    try:
+        with open(os.path.join(index_dir, CURRENT_POINTER_NAME), 'r', encoding='utf-8') as f:
+            version = f.read().strip()
+    except FileNotFoundError:
+        return None
+    return version or None
+
+
+def get_snapshot_dir(index_dir: str, version: str) -> str:
+    return os.path.join(index_dir, SNAPSHOTS_DIR_NAME, version)
+
+
+def resolve_index_paths(index_path: str, mapping_path: str) -> tuple[str, str, str | None]:
+    """返回当前快照中的 (索引路径, 映射路径, 版本号)。没有 CURRENT 指针时回退到旧的单文件布局, 版本号为 None。"""
+    index_dir = os.path.dirname(index_path)
+    version = read_current_version(index_dir)
+    if version is None:
+        return index_path, mapping_path, None
+    snapshot_dir = get_snapshot_dir(index_dir, version)
+    return (os.path.join(snapshot_dir, os.path.basename(index_path)),
+            os.path.join(snapshot_dir, os.path.basename(mapping_path)),
+            version)
+
+
+def create_snapshot_dir(index_dir: str) -> tuple[str, str]:
+    version = f"v{time.time_ns()}"
+    snapshot_dir = get_snapshot_dir(index_dir, version)
+    os.makedirs(snapshot_dir)
+    return version, snapshot_dir
+
+
+def publish_snapshot(index_dir: str, version: str, keep: int = SNAPSHOT_KEEP):
+    # 先写临时文件并 fsync, 再用 os.replace 原子替换指针, 读取方要么看到旧版本, 要么看到新版本
+    pointer_path = os.path.join(index_dir, CURRENT_POINTER_NAME)
+    tmp_path = f"{pointer_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        f.write(version)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, pointer_path)
+    _fsync_dir(index_dir)
+    prune_snapshots(index_dir, keep)
+
+
+def read_index(index_path: str):
+    # 磁盘倒排列表文件按索引文件所在目录解析, 快照目录整体移动后依然可用
+    return faiss.read_index(index_path, faiss.IO_FLAG_ONDISK_SAME_DIR)
+
+
+def read_index_meta(index_path: str) -> dict:
+    meta_path = os.path.join(os.path.dirname(index_path), INDEX_META_NAME)
+    try:
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def write_index_meta(index_path: str, meta: dict):
+    meta_path = os.path.join(os.path.dirname(index_path), INDEX_META_NAME)
+    tmp_path = f"{meta_path}.tmp{os.getpid()}"
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(meta, f, ensure_ascii=False, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, meta_path)
+
+
+def write_snapshot(index, image_paths: list[str], index_path: str, mapping_path: str,
+                   extra_files: list[str] = (), meta: dict | None = None, link_files: list[str] = ()) -> str:
+    """发布新快照。index 可以是 Faiss 索引, 也可以是 faiss.serialize_index 得到的字节数组。
+
+    extra_files 会被移动到快照目录中; link_files 保留在原处, 以硬链接 (不支持时复制) 的方式加入快照目录。
+    """
+    index_dir = os.path.dirname(index_path)
+    version, snapshot_dir = create_snapshot_dir(index_dir)
+    for extra_file in extra_files:
+        # 例如磁盘倒排列表 (.ivfdata), 与索引文件放在同一个快照目录中
+        print(f"正在移动 {extra_file} 到快照目录 {snapshot_dir}")
+        os.replace(extra_file, os.path.join(snapshot_dir, os.path.basename(extra_file)))
+    for link_file in link_files:
+        # 例如上一个快照的近邻图; 旧快照被清理时硬链接的数据依然保留
+        _link_or_copy(link_file, os.path.join(snapshot_dir, os.path.basename(link_file)))
+    snapshot_index_path = os.path.join(snapshot_dir, os.path.basename(index_path))
+    snapshot_mapping_path = os.path.join(snapshot_dir, os.path.basename(mapping_path))
+    print(f"正在保存 Faiss CPU 索引到 {snapshot_index_path}")
+    if isinstance(index, np.ndarray):
+        with open(snapshot_index_path, 'wb') as f:
+            index.tofile(f)
+            f.flush()
+            os.fsync(f.fileno())
+    else:
+        faiss.write_index(index, snapshot_index_path)
+        _fsync_file(snapshot_index_path)
+    print(f"正在保存图像路径映射到 {snapshot_mapping_path}")
+    with open(snapshot_mapping_path, 'wb') as f:
+        pickle.dump(image_paths, f)
+        f.flush()
+        os.fsync(f.fileno())
+    if meta:
+        write_index_meta(snapshot_index_path, meta)
+    for extra_file in (*extra_files, *link_files):
+        _fsync_file(os.path.join(snapshot_dir, os.path.basename(extra_file)))
+    # 快照中的所有文件及其目录项落盘之后才移动 CURRENT 指针, 崩溃后指针不会指向不完整的快照
+    _fsync_dir(snapshot_dir)
+    publish_snapshot(index_dir, version)
+    print(f"已发布索引快照版本 {version}")
+    return version
+
+
+def republish_snapshot(index_dir: str, snapshot_index_path: str, meta: dict,
+                       extra_files: dict[str, str] | None = None) -> str:
+    """以已有快照的文件和新的元数据发布一个新版本, 正在运行的搜索器会热加载它。
+
+    extra_files 为 文件名 -> 源路径, 源文件被移动到新快照中, 替换已有快照中的同名文件。
+    """
+    extra_files = extra_files or {}
+    source_dir = os.path.dirname(snapshot_index_path)
+    version, snapshot_dir = create_snapshot_dir(index_dir)
+    for entry in os.scandir(source_dir):
+        # 跳过旧元数据、被替换的文件和临时文件
+        if (entry.is_file() and entry.name != INDEX_META_NAME and entry.name not in extra_files
+                and ".tmp" not in entry.name):
+            _link_or_copy(entry.path, os.path.join(snapshot_dir, entry.name))
+    for name, source in extra_files.items():
+        target = os.path.join(snapshot_dir, name)
+        os.replace(source, target)
+        _fsync_file(target)
+    write_index_meta(os.path.join(snapshot_dir, os.path.basename(snapshot_index_path)), meta)
+    _fsync_dir(snapshot_dir)
+    publish_snapshot(index_dir, version)
+    print(f"已发布索引快照版本 {version}")
+    return version
+
+
+def prune_snapshots(index_dir: str, keep: int = SNAPSHOT_KEEP):
+    snapshots_root = os.path.join(index_dir, SNAPSHOTS_DIR_NAME)
+    if not os.path.isdir(snapshots_root):
+        return
+    current = read_current_version(index_dir)
+    # 版本号为 v<纳秒时间戳>, 按数值排序即按发布时间排序
+    versions = sorted((entry.name for entry in os.scandir(snapshots_root)
+                       if entry.is_dir() and entry.name[1:].isdigit()),
+                      key=lambda name: int(name[1:]))
+    stale = [v for v in versions[:-keep] if v != current] if keep > 0 else []
+    for version in stale:
+        # 旧索引要么完全驻留内存, 要么 (磁盘倒排列表) 已被内存映射; POSIX 下删除已映射的文件不影响仍在服务中的搜索器,
+        # Windows 下删除失败会被忽略, 在下一次发布时重试
+        shutil.rmtree(get_snapshot_dir(index_dir, version), ignore_errors=True)
@@ -4,12 +4,13 @@ import os
 import time
 from PyQt5.QtWidgets import (QApplication, QWidget, QVBoxLayout, QHBoxLayout,
                              QPushButton, QLabel, QFileDialog, QScrollArea,
-                             QGridLayout, QFrame, QMessageBox)
+                             QGridLayout, QFrame, QMessageBox, QComboBox)
 from PyQt5.QtGui import QPixmap, QImage, QFont
 from PyQt5.QtCore import Qt, QThread, pyqtSignal, QTimer # QThread 仍然需要用于 SearchWorker
 
 from core.config import (K_RESULTS, QUERY_IMG_DISPLAY_SIZE, RESULT_IMG_DISPLAY_SIZE,
-                         GRID_COLS) # FAISS_INDEX_TYPE_CPU 不再需要导入这里
+                         GRID_COLS, DEFAULT_COLLECTION) # FAISS_INDEX_TYPE_CPU 不再需要导入这里
+from core.resources import apply_faiss_threads, query_slot
 
 # SearchWorker 现在需要从 main_app.py 导入 (或者定义在 main_window.py 如果更集中)
 # 为了保持 main_window.py 的纯UI和主逻辑，我们假设 SearchWorker 仍在 workers.py 或 main_app.py
@@ -21,33 +22,43 @@ class SearchWorker(QThread):
     error_signal = pyqtSignal(str)
     progress_signal = pyqtSignal(str)
 
-    def __init__(self, feature_extractor, searcher, image_path, k):
+    def __init__(self, feature_extractor, searcher, image_path, k, registry=None, collection=None):
         super().__init__()
         self.feature_extractor = feature_extractor
         self.searcher = searcher
         self.image_path = image_path
         self.k = k
+        self.registry = registry # 指定 registry 时在后台线程中按需加载 collection 对应的搜索器
+        self.collection = collection
         self.query_feature = None
         self.total_time = 0.0
 
     def run(self):
         try:
             total_start_time = time.time()
-
-            self.progress_signal.emit("正在提取查询图像特征...")
-            extract_start_time = time.time()
-            self.query_feature = self.feature_extractor.extract_features(self.image_path)
-            extract_end_time = time.time()
-            if self.query_feature is None:
-                raise ValueError("无法提取查询图像特征。")
-            # print(f"特征提取耗时: {extract_end_time - extract_start_time:.2f}秒")
-
-            self.progress_signal.emit("正在 Faiss 索引中搜索...")
-            search_start_time = time.time()
-            if self.searcher.get_active_index() is None or self.searcher.get_active_index().ntotal == 0:
-                raise ValueError("Faiss 索引未加载或为空。")
-            search_results = self.searcher.search(self.query_feature, k=self.k)
-            search_end_time = time.time()
+            apply_faiss_threads() # Faiss OpenMP 线程数按线程生效, 在本线程中按线程预算设置
+
+            if self.registry is not None:
+                if not self.registry.is_loaded(self.collection):
+                    self.progress_signal.emit(f"正在加载图库 {self.collection} ...")
+                self.searcher = self.registry.get_searcher(self.collection)
+
+            # 并发查询数受线程预算限制, 超出的查询排队等待, 避免线程过度订阅拉高尾延迟
+            with query_slot():
+                self.progress_signal.emit("正在提取查询图像特征...")
+                extract_start_time = time.time()
+                self.query_feature = self.feature_extractor.extract_features(self.image_path)
+                extract_end_time = time.time()
+                if self.query_feature is None:
+                    raise ValueError("无法提取查询图像特征。")
+                # print(f"特征提取耗时: {extract_end_time - extract_start_time:.2f}秒")
+
+                self.progress_signal.emit("正在 Faiss 索引中搜索...")
+                search_start_time = time.time()
+                if self.searcher.get_active_index() is None or self.searcher.get_active_index().ntotal == 0:
+                    raise ValueError("Faiss 索引未加载或为空。")
+                search_results = self.searcher.search(self.query_feature, k=self.k)
+                search_end_time = time.time()
 
             total_end_time = time.time()
             self.total_time = total_end_time - total_start_time
@@ -59,6 +70,43 @@ class SearchWorker(QThread):
             print(f"搜索线程错误: {e}")
             self.error_signal.emit(str(e))
 
+class NeighborWorker(QThread):
+    # "相似图像"跳转: 近邻图查表很快, 但图库可能已被卸载需要重新加载, 没有近邻图时还要回退为完整搜索, 都不能放在界面线程
+    results_signal = pyqtSignal(list, float)
+    error_signal = pyqtSignal(str)
+    progress_signal = pyqtSignal(str)
+
+    def __init__(self, searcher, image_path, k, registry=None, collection=None):
+        super().__init__()
+        self.searcher = searcher
+        self.image_path = image_path
+        self.k = k
+        self.registry = registry
+        self.collection = collection
+
+    def run(self):
+        try:
+            start_time = time.time()
+            apply_faiss_threads()
+            if self.registry is not None:
+                if not self.registry.is_loaded(self.collection):
+                    self.progress_signal.emit(f"正在加载图库 {self.collection} ...")
+                self.searcher = self.registry.get_searcher(self.collection)
+            with query_slot():
+                results = self.searcher.search_neighbors_of_path(self.image_path, k=self.k)
+            self.results_signal.emit(results, time.time() - start_time)
+        except Exception as e:
+            print(f"相似图像线程错误: {e}")
+            self.error_signal.emit(str(e))
+
+class ClickableLabel(QLabel):
+    clicked = pyqtSignal()
+
+    def mousePressEvent(self, event):
+        if event.button() == Qt.LeftButton:
+            self.clicked.emit()
+        super().mousePressEvent(event)
+
 class MainWindow(QWidget):
     def __init__(self):
         super().__init__()
@@ -70,6 +118,9 @@ class MainWindow(QWidget):
         self.search_worker = None
         self.query_file_path = None
         self.backend_ready = False
+        self.registry = None
+        self.current_collection = DEFAULT_COLLECTION
+        self.results_collection = DEFAULT_COLLECTION # 当前显示的结果所属的图库
 
         ui_init_start_time = time.time()
         print(f"  [计时] _init_ui 调用开始...")
@@ -80,10 +131,17 @@ class MainWindow(QWidget):
         app_init_end_time = time.time()
         print(f"[计时] MainWindow __init__ (仅UI框架) 总耗时: {app_init_end_time - app_init_start_time:.4f} 秒")
 
-    def finish_initialization(self, feature_extractor, searcher):
+    def finish_initialization(self, feature_extractor, searcher, registry=None):
         print("[主窗口] 接收到后端初始化完成信号。")
         self.feature_extractor = feature_extractor
         self.searcher = searcher
+        self.registry = registry
+        if self.registry is not None and len(self.registry.names()) > 1:
+            self.collection_combo.blockSignals(True)
+            self.collection_combo.addItems(self.registry.names())
+            self.collection_combo.setCurrentText(self.current_collection)
+            self.collection_combo.blockSignals(False)
+            self.collection_combo.show()
         self.backend_ready = True
         self.upload_button.setEnabled(True)
         self.upload_button.setToolTip("选择一张本地图像进行相似性检索")
@@ -158,7 +216,14 @@ class MainWindow(QWidget):
         self.query_image_label.setFixedSize(QUERY_IMG_DISPLAY_SIZE, QUERY_IMG_DISPLAY_SIZE)
         self.query_image_label.setAlignment(Qt.AlignCenter)
 
+        self.collection_combo = QComboBox()
+        self.collection_combo.setMinimumHeight(40)
+        self.collection_combo.setToolTip("选择要检索的图库")
+        self.collection_combo.currentTextChanged.connect(self._change_collection)
+        self.collection_combo.hide() # 只有配置了多个图库时才显示
+
         query_layout.addWidget(self.upload_button)
+        query_layout.addWidget(self.collection_combo)
         query_layout.addSpacing(20)
         query_layout.addWidget(self.query_image_label)
         query_layout.addStretch()
@@ -209,7 +274,8 @@ class MainWindow(QWidget):
                  self._show_error_message("严重错误：特征提取器或搜索器未正确初始化！")
                  return
 
-            self.search_worker = SearchWorker(self.feature_extractor, self.searcher, file_path, K_RESULTS) # SearchWorker 从本文件定义
+            self.search_worker = SearchWorker(self.feature_extractor, self.searcher, file_path, K_RESULTS,
+                                              registry=self.registry, collection=self.current_collection) # SearchWorker 从本文件定义
             self.search_worker.results_signal.connect(self._display_results)
             self.search_worker.error_signal.connect(self._handle_search_error)
             self.search_worker.progress_signal.connect(self._update_status_from_worker)
@@ -220,6 +286,15 @@ class MainWindow(QWidget):
             self.upload_button.setText("正在搜索中...")
 
 
+    def _change_collection(self, name: str):
+        if not name or name == self.current_collection:
+            return
+        self.current_collection = name
+        stats = self.registry.get_stats()[name]
+        print(f"[主窗口] 切换到图库 '{name}'。图库统计: {self.registry.get_stats()}")
+        load_state = "已加载" if stats["loaded"] else "将在首次查询时加载"
+        self.status_label.setText(f"状态：已切换到图库 {name} ({load_state}，加载 {stats['loads']} 次，命中 {stats['hits']} 次)。请上传查询图像。")
+
     def _update_status_from_worker(self, message):
         self.status_label.setText(f"状态：{message}")
         QApplication.processEvents()
@@ -238,7 +313,9 @@ class MainWindow(QWidget):
 
         row, col = 0, 0
         for img_path, score in results: # ★ 不再使用 score 来显示 ★
-            img_label = QLabel()
+            img_label = ClickableLabel()
+            img_label.setCursor(Qt.PointingHandCursor)
+            img_label.clicked.connect(lambda path=img_path: self._show_neighbors(path))
             img_label.setObjectName("ResultImageLabel")
             if not os.path.exists(img_path):
                 print(f"警告：结果图像路径无效: {img_path}")
@@ -253,7 +330,7 @@ class MainWindow(QWidget):
             
             img_label.setFixedSize(RESULT_IMG_DISPLAY_SIZE, RESULT_IMG_DISPLAY_SIZE)
             img_label.setAlignment(Qt.AlignCenter)
-            img_label.setToolTip(f"路径: {os.path.basename(img_path)}") # ★ Tooltip 中也不再显示得分 ★
+            img_label.setToolTip(f"路径: {os.path.basename(img_path)}\n单击查看与它相似的图像") # ★ Tooltip 中也不再显示得分 ★
             # img_label.setStyleSheet("border: 1px solid #e0e0e0; border-radius: 3px;") # 可以通过setObjectName设置
             self.results_layout.addWidget(img_label, row, col)
 
@@ -261,12 +338,39 @@ class MainWindow(QWidget):
             if col >= GRID_COLS: col = 0; row += 1
         self.status_label.setText(f"状态：检索完成！显示 {len(results)} 个结果。总耗时: {duration:.2f} 秒。")
 
+    def _show_neighbors(self, img_path: str):
+        # 以某个结果为新的查询: 优先从预计算的近邻图中 O(1) 取出, 无需重新提取特征
+        if self.search_worker and self.search_worker.isRunning():
+            return
+        pixmap = QPixmap(img_path)
+        if not pixmap.isNull():
+            self.query_image_label.setPixmap(pixmap.scaled(QUERY_IMG_DISPLAY_SIZE, QUERY_IMG_DISPLAY_SIZE, Qt.KeepAspectRatio, Qt.SmoothTransformation))
+        self.query_file_path = img_path
+        # 只传图库名称, 不持有其它图库的搜索器引用, 否则被注册表卸载的索引无法释放
+        self.search_worker = NeighborWorker(self.searcher, img_path, K_RESULTS,
+                                            registry=self.registry, collection=self.results_collection)
+        self.search_worker.results_signal.connect(self._display_neighbors)
+        self.search_worker.error_signal.connect(self._handle_neighbor_error)
+        self.search_worker.progress_signal.connect(self._update_status_from_worker)
+        self.search_worker.finished.connect(self._search_finished)
+        self.search_worker.start()
+        self.upload_button.setEnabled(False)
+
+    def _display_neighbors(self, results: list[tuple[str, float]], duration: float):
+        self._display_results(None, results, duration)
+        self.status_label.setText(f"状态：已跳转到 {os.path.basename(self.query_file_path)} 的相似图像，显示 {len(results)} 个结果。耗时: {duration * 1000:.2f} 毫秒。")
+
+    def _handle_neighbor_error(self, error_message):
+        self._show_error_message(f"查找相似图像时发生错误: {error_message}") # 线程结束后由 finished 信号收尾
+
     def _handle_search_error(self, error_message):
         self._show_error_message(f"检索过程中发生错误: {error_message}")
         self._search_finished()
 
     def _search_finished(self):
         print("搜索线程结束。")
+        if self.search_worker is not None and self.search_worker.collection is not None:
+            self.results_collection = self.search_worker.collection # 结果中的"相似图像"跳转使用本次检索所在的图库
         if self.backend_ready: self.upload_button.setEnabled(True); self.upload_button.setText("选择查询图像")
         self.search_worker = None
 
@@ -7,28 +7,36 @@ from PyQt5.QtGui import QFont, QColor, QPalette
 from PyQt5.QtCore import Qt, QTimer, QThread, pyqtSignal
 
 from gui.main_window import MainWindow
-from core.config import INDEX_PATH, MAPPING_PATH, DATA_DIR, VIT_MODEL_NAME
+from core.config import (INDEX_PATH, MAPPING_PATH, DATA_DIR, VIT_MODEL_NAME, INGEST_ENABLED,
+                         DEFAULT_COLLECTION, APP_RESOURCE_MODE)
 from core.feature_extractor import ViTFeatureExtractor
-from core.searcher import FaissSearcher
+from core.ingest import LiveIngestor
+from core.registry import CollectionRegistry
+from core.resources import apply_thread_budget
+from core.snapshot import resolve_index_paths
 
 # --- 后台初始化工作线程 ---
 class BackendInitializerWorker(QThread):
 
-    initialization_finished = pyqtSignal(object, object)
+    initialization_finished = pyqtSignal(object, object, object)
     initialization_error = pyqtSignal(str)
     progress_updated = pyqtSignal(str)
 
-    def __init__(self):
+    def __init__(self, thread_budget):
         super().__init__()
+        self.thread_budget = thread_budget
         self.feature_extractor = None
         self.searcher = None
+        self.registry = None
+        self.ingestor = None
 
     def run(self):
         try:
             self.progress_updated.emit("正在初始化 ViT 特征提取器...")
             print("[后台初始化] 初始化 ViT 特征提取器...")
             vit_init_start_time = time.time()
-            self.feature_extractor = ViTFeatureExtractor(model_name=VIT_MODEL_NAME)
+            self.feature_extractor = ViTFeatureExtractor(model_name=VIT_MODEL_NAME,
+                                                         decode_workers=self.thread_budget["decode_workers"])
             vit_init_end_time = time.time()
             print(f"  [后台计时] ViTFeatureExtractor 实例化耗时: {vit_init_end_time - vit_init_start_time:.4f} 秒")
             if self.feature_extractor is None:
@@ -38,15 +46,24 @@ class BackendInitializerWorker(QThread):
             self.progress_updated.emit("正在初始化 Faiss 搜索器 (加载索引)...")
             print("[后台初始化] 初始化 Faiss 搜索器...")
             searcher_init_start_time = time.time()
-            self.searcher = FaissSearcher(index_path=INDEX_PATH, mapping_path=MAPPING_PATH)
+            # 所有图库共享同一个特征提取器; 默认图库立即加载, 其余图库在首次查询时加载
+            self.registry = CollectionRegistry(self.feature_extractor)
+            try:
+                self.searcher = self.registry.get_searcher(DEFAULT_COLLECTION)
+            except RuntimeError:
+                raise RuntimeError(f"加载 Faiss 索引失败。请检查 '{INDEX_PATH}' 和 '{MAPPING_PATH}'。")
+            self.registry.pin(DEFAULT_COLLECTION)
             searcher_init_end_time = time.time()
             print(f"  [后台计时] FaissSearcher 实例化 (含加载) 耗时: {searcher_init_end_time - searcher_init_start_time:.4f} 秒")
-            if self.searcher.get_active_index() is None:
-                raise RuntimeError(f"加载 Faiss 索引失败。请检查 '{INDEX_PATH}' 和 '{MAPPING_PATH}'。")
             print(f"[后台初始化] Faiss 初始化成功。{self.searcher.get_index_status()}")
 
+            if INGEST_ENABLED:
+                self.progress_updated.emit("正在启动数据目录实时入库...")
+                self.ingestor = LiveIngestor(self.feature_extractor, self.searcher, DATA_DIR)
+                self.ingestor.start()
+
             self.progress_updated.emit("后端组件初始化完成！")
-            self.initialization_finished.emit(self.feature_extractor, self.searcher)
+            self.initialization_finished.emit(self.feature_extractor, self.searcher, self.registry)
         except Exception as e:
             error_msg = f"后端初始化过程中发生错误: {e}"
             print(f"[后台错误] {error_msg}")
@@ -117,8 +134,9 @@ def check_prerequisites():
     if not os.path.exists(DATA_DIR): errors.append(f"数据目录 '{DATA_DIR}' 不存在。")
     elif not any(fname.lower().endswith(('.png', '.jpg', '.jpeg', '.bmp', '.gif')) for fname in os.listdir(DATA_DIR)):
         errors.append(f"数据目录 '{DATA_DIR}' 为空或不包含图像文件，请放入图片。")
-    if not os.path.exists(INDEX_PATH): errors.append(f"Faiss 索引文件 '{INDEX_PATH}' 未找到。")
-    if not os.path.exists(MAPPING_PATH): errors.append(f"图像路径映射文件 '{MAPPING_PATH}' 未找到。")
+    index_path, mapping_path, _ = resolve_index_paths(INDEX_PATH, MAPPING_PATH)
+    if not os.path.exists(index_path): errors.append(f"Faiss 索引文件 '{index_path}' 未找到。")
+    if not os.path.exists(mapping_path): errors.append(f"图像路径映射文件 '{mapping_path}' 未找到。")
 
     if errors:
         error_message = "应用程序无法启动，缺少必要文件或目录：\n\n"
@@ -131,8 +149,9 @@ def check_prerequisites():
     return True
 
 class ApplicationController:
-    def __init__(self, app):
+    def __init__(self, app, thread_budget):
         self.app = app
+        self.thread_budget = thread_budget
         self.splash = None
         self.main_window = None
         self.backend_initializer = None
@@ -146,19 +165,22 @@ class ApplicationController:
         self.splash.show()
         self.app.processEvents()
 
-        self.backend_initializer = BackendInitializerWorker()
+        self.backend_initializer = BackendInitializerWorker(self.thread_budget)
         self.backend_initializer.initialization_finished.connect(self.on_backend_ready)
         self.backend_initializer.initialization_error.connect(self.on_backend_error)
         self.backend_initializer.progress_updated.connect(self.splash.update_progress_text)
         self.backend_initializer.start()
 
-    def on_backend_ready(self, feature_extractor, searcher):
+    def on_backend_ready(self, feature_extractor, searcher, registry):
         print("[主流程] 后端初始化成功完成。")
         self.splash.update_progress_text("加载完成，正在启动主界面...")
         self.app.processEvents()
 
+        self.app.aboutToQuit.connect(registry.close)
+        if self.backend_initializer.ingestor is not None:
+            self.app.aboutToQuit.connect(self.backend_initializer.ingestor.stop)
         self.main_window = MainWindow()
-        self.main_window.finish_initialization(feature_extractor, searcher)
+        self.main_window.finish_initialization(feature_extractor, searcher, registry)
         QTimer.singleShot(500, self._show_main_window)
 
     def _show_main_window(self):
@@ -177,8 +199,10 @@ class ApplicationController:
 if __name__ == '__main__':
     app_start_time = time.time()
     print("应用程序启动...")
+    # 在加载模型和索引之前为 torch / Faiss 分配线程预算
+    thread_budget = apply_thread_budget(APP_RESOURCE_MODE)
     app = QApplication(sys.argv) 
-    controller = ApplicationController(app)
+    controller = ApplicationController(app, thread_budget)
     controller.start()
     exit_code = app.exec_()
     app_end_time = time.time()
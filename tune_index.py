@@ -0,0 +1,149 @@
+# tune_index.py
+# 搜索参数自动调优: 从当前索引快照中抽样查询向量, 遍历 Faiss ParameterSpace 中的参数组合 (nprobe / efSearch 等),
+# 求出 recall@k 与延迟的帕累托前沿, 把满足目标 (例如 recall@5 >= 0.95 且 p99 < 5 ms) 的最低延迟参数写入元数据
+# 并发布为新的快照版本, 正在运行的 FaissSearcher 会热加载并立即应用。
+import argparse
+import os
+import time
+import faiss
+import numpy as np
+from core.config import INDEX_PATH, MAPPING_PATH, K_RESULTS
+from core.knn_graph import vector_index
+from core.searcher import is_ivf_index
+from core.snapshot import (read_index, read_index_meta, republish_snapshot, resolve_index_paths,
+                           write_index_meta)
+
+
+def sample_queries(index, num_queries: int, seed: int) -> tuple[np.ndarray, np.ndarray]:
+    # index 为 vector_index 得到的子索引: 白化 PCA 不可逆, 只能在降维后的向量空间中取回查询向量
+    rng = np.random.default_rng(seed)
+    query_ids = np.sort(rng.choice(index.ntotal, min(num_queries, index.ntotal), replace=False)).astype('int64')
+    queries = np.vstack([index.reconstruct(int(i)) for i in query_ids]).astype('float32')
+    return query_ids, queries
+
+
+def search_excluding_self(index, queries: np.ndarray, query_ids: np.ndarray, k: int) -> np.ndarray:
+    # 查询向量取自索引本身, 多取一个结果并去掉自身
+    _, neighbors = index.search(queries, k + 1)
+    is_self = neighbors == query_ids[:, None]
+    order = np.argsort(is_self, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(neighbors, order, axis=1)
+
+
+def exact_ground_truth(index, queries: np.ndarray, query_ids: np.ndarray, k: int) -> np.ndarray:
+    # 以同一向量表示上的穷举搜索为基准: IVF 访问全部倒排列表, HNSW 在内部存储的向量上暴力搜索
+    if is_ivf_index(index):
+        faiss.ParameterSpace().set_index_parameter(index, "nprobe", faiss.extract_index_ivf(index).nlist)
+        return search_excluding_self(index, queries, query_ids, k)
+    if isinstance(index, faiss.IndexHNSW):
+        index = faiss.downcast_index(index.storage)
+    return search_excluding_self(index, queries, query_ids, k)
+
+
+def recall_at_k(result_ids: np.ndarray, gt_ids: np.ndarray) -> float:
+    hits = sum(len(set(r) & set(g)) for r, g in zip(result_ids, gt_ids))
+    return hits / gt_ids.size
+
+
+def measure_latency_ms(index, queries: np.ndarray, k: int) -> tuple[float, float, float]:
+    index.search(queries[:1], k + 1) # 预热
+    latencies = []
+    for i in range(queries.shape[0]):
+        start = time.perf_counter()
+        index.search(queries[i:i + 1], k + 1)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return float(np.mean(latencies)), float(np.percentile(latencies, 50)), float(np.percentile(latencies, 99))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="在 recall@k / 延迟目标下自动调优索引搜索参数")
+    parser.add_argument("--k", type=int, default=K_RESULTS, help="recall@k 中的 k")
+    parser.add_argument("--min-recall", type=float, default=0.95, help="目标 recall@k 下限")
+    parser.add_argument("--max-p99-ms", type=float, default=5.0, help="目标单次查询 p99 延迟上限 (毫秒)")
+    parser.add_argument("--queries", type=int, default=1000, help="用于测 recall 的抽样查询数")
+    parser.add_argument("--latency-queries", type=int, default=300, help="用于测单次查询延迟分布的查询数")
+    parser.add_argument("--seed", type=int, default=0, help="抽样随机种子")
+    parser.add_argument("--dry-run", action="store_true", help="只输出结果, 不写入元数据")
+    args = parser.parse_args()
+
+    overall_start_time = time.time()
+    index_path, _, version = resolve_index_paths(INDEX_PATH, MAPPING_PATH)
+    print(f"[信息] 正在加载索引 {index_path} (版本: {version or '未版本化'})")
+    # 与 build_knn_graph 相同, 直接在 PCA 之后的子索引上评估; 搜索参数名对外层索引同样适用
+    index = vector_index(read_index(index_path))
+    if index.ntotal <= args.k:
+        print(f"[错误] 索引只有 {index.ntotal} 个向量，无法评估 recall@{args.k}。")
+        exit(1)
+
+    ps = faiss.ParameterSpace()
+    ps.initialize(index)
+    num_combinations = ps.n_combinations()
+    # 精确索引 (IndexFlat*) 没有可调参数, 但 n_combinations() 仍返回 1 (空参数组合)
+    if ps.parameter_ranges.size() == 0:
+        print("[信息] 当前索引类型为精确搜索，没有可调的搜索参数。")
+        exit(0)
+
+    query_ids, queries = sample_queries(index, args.queries, args.seed)
+    gt_start = time.time()
+    gt_ids = exact_ground_truth(index, queries, query_ids, args.k)
+    print(f"  [计时] 计算 {len(query_ids)} 个查询的精确近邻耗时: {time.time() - gt_start:.4f} 秒")
+
+    # 第一轮: 批量搜索遍历所有参数组合, 用 OperatingPoints 维护 recall-耗时帕累托前沿
+    operating_points = faiss.OperatingPoints()
+    print(f"[信息] 共 {num_combinations} 个参数组合:")
+    for cno in range(num_combinations):
+        key = ps.combination_name(cno)
+        ps.set_index_parameters(index, key)
+        start = time.perf_counter()
+        result_ids = search_excluding_self(index, queries, query_ids, args.k)
+        ms_per_query = (time.perf_counter() - start) * 1000 / len(query_ids)
+        recall = recall_at_k(result_ids, gt_ids)
+        operating_points.add(recall, ms_per_query, key, cno)
+        print(f"  {key:<30} recall@{args.k} = {recall:.4f}  批量 {ms_per_query:.4f} ms/查询")
+
+    # 第二轮: 对前沿上的点逐条查询, 测量单次查询的延迟分布
+    frontier = []
+    for i in range(operating_points.optimal_pts.size()):
+        point = operating_points.optimal_pts.at(i)
+        if not point.key:
+            continue # OperatingPoints 自带的起始点 (空参数, recall 为 0), 不是真实的参数组合
+        ps.set_index_parameters(index, point.key)
+        mean_ms, p50_ms, p99_ms = measure_latency_ms(index, queries[:args.latency_queries], args.k)
+        frontier.append({"search_params": point.key, f"recall@{args.k}": point.perf,
+                         "mean_ms": mean_ms, "p50_ms": p50_ms, "p99_ms": p99_ms})
+
+    print(f"[信息] 帕累托前沿 ({len(frontier)} 个点):")
+    for point in frontier:
+        print(f"  {point['search_params']:<30} recall@{args.k} = {point[f'recall@{args.k}']:.4f}  "
+              f"p50 {point['p50_ms']:.3f} ms  p99 {point['p99_ms']:.3f} ms")
+
+    feasible = [p for p in frontier
+                if p[f"recall@{args.k}"] >= args.min_recall and p["p99_ms"] < args.max_p99_ms]
+    if not feasible:
+        print(f"[失败] 没有参数组合同时满足 recall@{args.k} >= {args.min_recall} 且 p99 < {args.max_p99_ms} ms。")
+        exit(1)
+    best = min(feasible, key=lambda p: p["mean_ms"])
+    print(f"[成功] 最低延迟的满足目标的参数: {best['search_params']} "
+          f"(recall@{args.k} = {best[f'recall@{args.k}']:.4f}, p99 {best['p99_ms']:.3f} ms)")
+
+    if not args.dry_run:
+        # 调优期间实时入库可能已发布更新的快照; 索引结构相同, 参数直接应用到当前快照, 避免回退到旧版本
+        index_path, _, current_version = resolve_index_paths(INDEX_PATH, MAPPING_PATH)
+        if current_version != version:
+            print(f"[信息] 调优期间发布了新快照 {current_version}，搜索参数将应用到该版本。")
+        meta = read_index_meta(index_path)
+        meta["search_params"] = best["search_params"]
+        meta["tuning"] = {
+            "target": {"k": args.k, "min_recall": args.min_recall, "max_p99_ms": args.max_p99_ms},
+            "selected": best,
+            "frontier": frontier,
+            "num_queries": len(query_ids),
+            "tuned_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        if current_version is None:
+            write_index_meta(index_path, meta)
+            print(f"[成功] 搜索参数已写入 {index_path} 所在目录的元数据，下次加载索引时自动生效。")
+        else:
+            new_version = republish_snapshot(os.path.dirname(INDEX_PATH), index_path, meta)
+            print(f"[成功] 搜索参数已发布为快照 {new_version}，正在运行的 main_app.py 会自动热加载。")
+    print(f"总耗时: {time.time() - overall_start_time:.2f} 秒。")